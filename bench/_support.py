@@ -0,0 +1,35 @@
+"""
+Shared helpers for the benchmark suite: makes src/ importable and
+reduces raw timing samples to comparable metrics.
+"""
+from pathlib import Path
+from statistics import median, quantiles
+from sys import path
+from time import perf_counter
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_DIR) not in path:
+    path.insert(0, str(SRC_DIR))
+
+
+def time_calls(fn: callable, repeat: int) -> list[float]:
+    samples = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        samples.append(perf_counter() - start)
+
+    return samples
+
+
+def summarize(samples: list[float]) -> dict:
+    p99 = quantiles(samples, n=100)[-1] if len(samples) > 1 else samples[0]
+    return {
+        "median_us": median(samples) * 1e6,
+        "p99_us": p99 * 1e6,
+        "ops_per_s": len(samples) / sum(samples) if sum(samples) else 0.0,
+    }
+
+
+def result(name: str, params: dict, metrics: dict) -> dict:
+    return {"name": name, "params": params, **metrics}
@@ -0,0 +1,63 @@
+"""
+File.encrypt/decrypt throughput across file sizes, for incompressible
+data and for text-like data with each available compression.
+"""
+from os import urandom
+from pathlib import Path
+
+from _support import time_calls, result
+from codec import Codec
+from file import File
+from helpers import keygen
+
+QUICK_SIZES = [64 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+FULL_SIZES = QUICK_SIZES + [128 * 1024 * 1024]
+_TEXT_LINE = b"2024-01-01T00:00:00Z,fstoken,bench,INFO,request served in 12ms\n"
+
+
+def _make_content(kind: str, size: int) -> bytes:
+    if kind == "random":
+        return urandom(size)
+
+    return (_TEXT_LINE * (size // len(_TEXT_LINE) + 1))[:size]
+
+
+def _throughput(size: int, samples: list[float]) -> float:
+    return size / (1024 * 1024) / min(samples)
+
+
+def run(full: bool, workdir: Path) -> list[dict]:
+    results = []
+    filekey = keygen()
+    file = workdir / "crypto.bin"
+    cases = [("random", "")] + [("text", "")] \
+        + [("text", algorithm) for algorithm in Codec.get_available_algorithms()]
+
+    for size in FULL_SIZES if full else QUICK_SIZES:
+        repeat = 5 if size <= 1024 * 1024 else 2
+        for (kind, compression) in cases:
+            file.write_bytes(_make_content(kind, size))
+
+            encrypt_samples = []
+            decrypt_samples = []
+            encrypted_size = 0
+            for _ in range(repeat):
+                encrypt_samples += time_calls(
+                    lambda: File.encrypt(str(file), filekey, compression), 1)
+                encrypted_size = file.stat().st_size
+                decrypt_samples += time_calls(
+                    lambda: File.decrypt(str(file), filekey, compression), 1)
+
+            params = {"size_bytes": size,
+                      "content": kind,
+                      "compression": compression or "none"}
+            results.append(result("file.encrypt", params, {
+                "mb_per_s": _throughput(size, encrypt_samples),
+                "size_ratio": encrypted_size / size,
+            }))
+            results.append(result("file.decrypt", params, {
+                "mb_per_s": _throughput(size, decrypt_samples),
+            }))
+
+    file.unlink()
+    return results
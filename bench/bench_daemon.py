@@ -0,0 +1,106 @@
+"""
+Daemon round trips under N concurrent client processes, for a bare
+stats call and for non-interactive reads of an encrypted file.
+"""
+from argparse import Namespace
+from base64 import b64encode
+from multiprocessing import get_context
+from os import environ, urandom
+from pathlib import Path
+from subprocess import Popen, DEVNULL
+from sys import executable
+from time import perf_counter, sleep
+
+from _support import SRC_DIR, result
+from captoken import Token
+from client import Client
+from file import File
+from keystore import Keystore
+from operation import Read, Stats
+
+QUICK_CLIENTS = [1, 4, 16]
+FULL_CLIENTS = QUICK_CLIENTS + [64]
+_DAEMON_START_TIMEOUT_S = 10
+
+
+def start_daemon() -> Popen:
+    daemon = Popen([executable, str(SRC_DIR / "daemon.py")],
+                   env=environ.copy(), stdout=DEVNULL, stderr=DEVNULL)
+
+    deadline = perf_counter() + _DAEMON_START_TIMEOUT_S
+    while not Path(Client.SOCK_ADDRESS).exists():
+        if perf_counter() > deadline or daemon.poll() is not None:
+            daemon.kill()
+            raise RuntimeError("fstoken daemon failed to start")
+        sleep(0.05)
+
+    return daemon
+
+
+def _enroll(workdir: Path, cache: bool) -> Read:
+    file = workdir / f"daemon_{'cached' if cache else 'plain'}.txt"
+    file.write_text("fstoken benchmark line\n" * 200)
+
+    options = {"cache": "1"} if cache else {}
+    filekey = Keystore.change_entry(str(file), encrypt=True, options=options)
+    File.encrypt(str(file), filekey)
+
+    seed = b64encode(urandom(32)).decode("utf-8")
+    token = Token.encode(seed, raw_payload={"filekey": filekey,
+                                            "grant": "r",
+                                            "proof": [""]})
+    return Read(Namespace(file=str(file), token=token))
+
+
+def _client_worker(job: tuple) -> tuple[list[float], int]:
+    (operation, duration_s) = job
+
+    latencies = []
+    errors = 0
+    deadline = perf_counter() + duration_s
+    while perf_counter() < deadline:
+        start = perf_counter()
+        call_result = Client.call_daemon(operation)
+        latencies.append(perf_counter() - start)
+        errors += 1 if call_result.err else 0
+
+    return latencies, errors
+
+
+def _drive(operation, clients: int, duration_s: float) -> dict:
+    with get_context("fork").Pool(clients) as pool:
+        start = perf_counter()
+        outcomes = pool.map(_client_worker, [(operation, duration_s)] * clients)
+        elapsed = perf_counter() - start
+
+    latencies = sorted(lat for (lats, _) in outcomes for lat in lats)
+    errors = sum(errs for (_, errs) in outcomes)
+    return {
+        "ops_per_s": len(latencies) / elapsed,
+        "p50_us": latencies[len(latencies) // 2] * 1e6,
+        "p99_us": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6,
+        "error_rate": errors / len(latencies),
+    }
+
+
+def run(full: bool, workdir: Path) -> list[dict]:
+    Keystore._KEYSTORE_PATH.write_text("")
+    operations = {
+        "daemon.stats": Stats(Namespace()),
+        "daemon.read": _enroll(workdir, cache=False),
+        "daemon.read_cached": _enroll(workdir, cache=True),
+    }
+    duration_s = 5.0 if full else 1.0
+
+    results = []
+    daemon = start_daemon()
+    try:
+        for clients in FULL_CLIENTS if full else QUICK_CLIENTS:
+            for (name, operation) in operations.items():
+                results.append(result(name, {"clients": clients},
+                                      _drive(operation, clients, duration_s)))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    return results
@@ -0,0 +1,48 @@
+"""
+Keystore lookups and updates as the number of entries grows. Every
+call reads the whole keystore file, so costs scale with its size.
+"""
+from pathlib import Path
+from random import Random
+
+from _support import time_calls, summarize, result
+from keystore import Keystore
+from helpers import keygen
+
+QUICK_SIZES = [10**2, 10**3, 10**4]
+FULL_SIZES = QUICK_SIZES + [10**5, 10**6]
+
+
+def _populate(entries: int) -> list[str]:
+    # A single key is reused, generating 10^6 of them dominates setup
+    filekey = keygen()
+    filestrings = [f"/bench/dir{idx % 1000}/file{idx}" for idx in range(entries)]
+    with open(Keystore._KEYSTORE_PATH, "w") as ks:
+        for filestring in filestrings:
+            ks.write(Keystore._create_entry_repr((filestring, "0", filekey, "")))
+
+    return filestrings
+
+
+def run(full: bool, workdir: Path) -> list[dict]:
+    results = []
+    rand = Random(0)
+    for entries in FULL_SIZES if full else QUICK_SIZES:
+        filestrings = _populate(entries)
+        lookups = max(5, min(200, 10**6 // entries))
+        updates = max(3, min(50, 10**5 // entries))
+
+        targets = [rand.choice(filestrings) for _ in range(lookups)]
+        samples = time_calls(lambda: Keystore.search_entry(targets.pop()), lookups)
+        results.append(result("keystore.search_entry", {"entries": entries},
+                              summarize(samples)))
+
+        targets = [rand.choice(filestrings) for _ in range(updates)]
+        samples = time_calls(
+            lambda: Keystore.change_entry(targets.pop(), options={"cache": "1"}),
+            updates
+        )
+        results.append(result("keystore.change_entry", {"entries": entries},
+                              summarize(samples)))
+
+    return results
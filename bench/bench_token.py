@@ -0,0 +1,43 @@
+"""
+Token validation across delegation chain depths, with and without the
+validation cache.
+"""
+from base64 import b64encode
+from os import urandom
+from pathlib import Path
+
+from _support import time_calls, summarize, result
+from captoken import Token
+from helpers import keygen
+
+QUICK_DEPTHS = [1, 2, 4, 8]
+FULL_DEPTHS = QUICK_DEPTHS + [16, 32]
+
+
+def _build_chain(depth: int, filekey: str) -> str:
+    token = ""
+    for _ in range(depth):
+        seed = b64encode(urandom(32)).decode("utf-8")
+        token = Token.encode(seed, raw_payload={"filekey": filekey,
+                                                "grant": "rw",
+                                                "proof": [token]})
+
+    return token
+
+
+def run(full: bool, workdir: Path) -> list[dict]:
+    results = []
+    filekey = keygen()
+    repeat = 200 if full else 50
+    for depth in FULL_DEPTHS if full else QUICK_DEPTHS:
+        token = _build_chain(depth, filekey)
+
+        samples = time_calls(lambda: Token.validate(token, None, filekey), repeat)
+        results.append(result("token.validate", {"depth": depth},
+                              summarize(samples)))
+
+        samples = time_calls(lambda: Token.validate_cached(token, filekey), repeat)
+        results.append(result("token.validate_cached", {"depth": depth},
+                              summarize(samples)))
+
+    return results
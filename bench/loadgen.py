@@ -0,0 +1,329 @@
+"""
+Load generator driving a local daemon from many concurrent client
+processes, started on a temporary socket and keystore.
+
+    python bench/loadgen.py --clients 32 --ramp-s 10 --duration-s 30 \
+                            --mix add=1,rotate=1,delegate=2,read=5,write=1
+
+Clients are started gradually over the ramp. Every second the tool
+reports throughput, tail latency, error rate and the daemon RSS and
+thread count. At the end it checks the keystore for lost or duplicated
+entries and that every encrypted file can still be decrypted with the
+key the keystore holds for it.
+"""
+from argparse import ArgumentParser, Namespace
+from base64 import b64encode
+from json import dumps
+from multiprocessing import get_context
+from os import environ, urandom
+from pathlib import Path
+from queue import Empty
+from random import Random
+from sys import exit, stderr
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep, time
+
+OPERATIONS = ["add", "rotate", "delegate", "read", "write"]
+SHARED_FILES_COUNT = 8
+SAMPLE_INTERVAL_S = 1.0
+
+
+def _op_args(file: str, **overrides) -> Namespace:
+    args = {"file": file, "keygen": False, "encrypt": True, "rotate": False,
+            "delete": False, "grant": [], "key": "", "token": "",
+            "cache": False, "compress": "", "stats": False, "batch": ""}
+    args.update(overrides)
+    return Namespace(**args)
+
+
+def _authorized(operation):
+    # Daemon and clients run as the same user here, the setfacl step of
+    # run_unpriviledged is skipped and its outcome asserted directly
+    operation._requester_has_access_to_file = True
+    return operation
+
+
+def _invoke_write(file: str, token: str, content: str) -> str:
+    from socket import socket, AF_UNIX, SOCK_STREAM
+    from client import Client, _SocketMessageBroker
+    from helpers import Message
+    from operation import Invoke
+
+    with socket(AF_UNIX, SOCK_STREAM) as conn:
+        conn.connect(Client.SOCK_ADDRESS)
+        _SocketMessageBroker.send_message(
+            conn, Message(Invoke(_op_args(file, token=token)), ""))
+
+        answer = _SocketMessageBroker.get_message(conn)
+        if answer.err:
+            return str(answer.err)
+
+        _SocketMessageBroker.send_message(conn, Message((file, content), ""))
+        return ""
+
+
+def _client_loop(client_id: int,
+                 workdir: Path,
+                 shared: list[tuple[str, str]],
+                 weights: dict[str, int],
+                 stop_at: float,
+                 records) -> None:
+    from client import Client
+    from operation import Add, Delegate, Read
+
+    rand = Random(client_id)
+    seed = b64encode(urandom(32)).decode("utf-8")
+    own_dir = workdir / "clients" / str(client_id)
+    own_dir.mkdir(parents=True)
+
+    added = 0
+    population = list(weights.keys())
+    cum_weights = list(weights.values())
+    try:
+        while time() < stop_at:
+            op_name = rand.choices(population, weights=cum_weights)[0]
+            (shared_file, shared_token) = rand.choice(shared)
+
+            start = perf_counter()
+            if op_name == "rotate" and added:
+                # Re-enrolling rewrites the keystore while others append to it
+                file = own_dir / f"file{rand.randrange(added)}.txt"
+                op = Add(_op_args(str(file), rotate=True))
+                err = Client.call_daemon(_authorized(op)).err
+            elif op_name in ("add", "rotate"):
+                op_name = "add"
+                file = own_dir / f"file{added}.txt"
+                file.write_text(f"client {client_id} file {added}\n" * 20)
+                err = Client.call_daemon(_authorized(Add(_op_args(str(file))))).err
+                if not err:
+                    added += 1
+                    records.put(("added", str(file)))
+            elif op_name == "delegate":
+                op = Delegate(_op_args(shared_file, grant=["r"], key=seed))
+                err = Client.call_daemon(_authorized(op)).err
+            elif op_name == "read":
+                err = Client.call_daemon(Read(_op_args(shared_file, token=shared_token))).err
+            else:
+                content = f"client {client_id} wrote at {time()}\n" * 20
+                err = _invoke_write(shared_file, shared_token, content)
+
+            records.put(("op", time(), op_name, perf_counter() - start, str(err or "")))
+    finally:
+        # Queued after every record of this client, marks it drained
+        records.put(("done", client_id))
+
+
+def _read_proc_status(pid: int) -> dict:
+    status = {}
+    try:
+        with open(f"/proc/{pid}/status", "r") as proc_status:
+            for line in proc_status:
+                (key, _, value) = line.partition(":")
+                if key in ("VmRSS", "Threads"):
+                    status[key] = int(value.split()[0])
+    except OSError:
+        pass
+
+    return {"rss_kb": status.get("VmRSS", 0), "threads": status.get("Threads", 0)}
+
+
+def _percentile(samples: list[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _enroll_shared(workdir: Path) -> list[tuple[str, str]]:
+    from captoken import Token
+    from file import File
+    from keystore import Keystore
+
+    shared = []
+    seed = b64encode(urandom(32)).decode("utf-8")
+    for idx in range(SHARED_FILES_COUNT):
+        file = workdir / f"shared{idx}.txt"
+        file.write_text(f"shared file {idx}\n" * 50)
+        filekey = Keystore.change_entry(str(file), encrypt=True)
+        File.encrypt(str(file), filekey)
+        token = Token.encode(seed, raw_payload={"filekey": filekey,
+                                                "grant": "rw",
+                                                "proof": [""]})
+        shared.append((str(file), token))
+
+    return shared
+
+
+def _check_keystore(added: list[str], shared: list[str]) -> dict:
+    from file import File
+    from keystore import Keystore
+
+    lines = Keystore._KEYSTORE_PATH.read_text().splitlines()
+    entries = [Keystore._parse_entry(line) for line in lines if line]
+    valid = [entry for entry in entries if entry is not None]
+    paths = [entry[0] for entry in valid]
+
+    unreadable = []
+    for file in [*shared, *added]:
+        (_, filekey, options) = Keystore.search_entry(file)
+        try:
+            File.decrypt_to_read(file, filekey, options.get("compress", ""))
+        except Exception:
+            unreadable.append(file)
+
+    return {
+        "entries": len(valid),
+        "invalid_lines": len(entries) - len(valid),
+        "duplicated_paths": len(paths) - len(set(paths)),
+        "missing_added": len(set(added) - set(paths)),
+        "missing_shared": len(set(shared) - set(paths)),
+        "unreadable": len(unreadable),
+    }
+
+
+def run(args: Namespace, workdir: Path) -> dict:
+    from bench_daemon import start_daemon
+
+    weights = {}
+    for part in args.mix.split(","):
+        (name, _, weight) = part.partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name}, available: {OPERATIONS}")
+        weights[name] = int(weight or 1)
+
+    shared = _enroll_shared(workdir)
+    daemon = start_daemon()
+
+    ctx = get_context("fork")
+    records = ctx.Queue()
+    stop_at = time() + args.ramp_s + args.duration_s
+    clients = []
+
+    timeline = []
+    latencies = {name: [] for name in weights}
+    errors = {name: 0 for name in weights}
+    error_samples = {}
+    added = []
+    start = time()
+    next_sample = start + SAMPLE_INTERVAL_S
+    interval = []
+    drained = set()
+    try:
+        # Records outlive their client, the queue is read until every
+        # client marked its end or died without being able to
+        while time() < stop_at or len(drained) < len(clients):
+            elapsed = time() - start
+            while len(clients) < args.clients \
+                    and elapsed >= len(clients) * args.ramp_s / args.clients:
+                client = ctx.Process(target=_client_loop,
+                                     args=(len(clients), workdir, shared,
+                                           weights, stop_at, records))
+                client.start()
+                clients.append(client)
+
+            try:
+                record = records.get(timeout=0.05)
+            except Empty:
+                record = None
+
+            if record is None:
+                drained |= {idx for (idx, c) in enumerate(clients)
+                            if c.exitcode not in (None, 0)}
+            elif record[0] == "done":
+                drained.add(record[1])
+            elif record[0] == "added":
+                added.append(record[1])
+            else:
+                (_, _, op_name, latency, err) = record
+                latencies[op_name].append(latency)
+                interval.append((latency, bool(err)))
+                if err:
+                    errors[op_name] += 1
+                    error_samples.setdefault(err.splitlines()[0][:120], 0)
+                    error_samples[err.splitlines()[0][:120]] += 1
+
+            if time() >= next_sample:
+                sample = {
+                    "t_s": round(time() - start, 1),
+                    "clients": sum(c.is_alive() for c in clients),
+                    "ops_per_s": len(interval) / SAMPLE_INTERVAL_S,
+                    "p99_ms": _percentile([lat for (lat, _) in interval], 0.99) * 1e3,
+                    "error_rate": sum(err for (_, err) in interval) / len(interval)
+                        if interval else 0.0,
+                    **_read_proc_status(daemon.pid),
+                }
+                timeline.append(sample)
+                print(dumps(sample), file=stderr)
+                interval = []
+                next_sample += SAMPLE_INTERVAL_S
+
+        for client in clients:
+            client.join()
+
+        # Every connection is closed, threads should be gone again
+        sleep(SAMPLE_INTERVAL_S)
+        idle = _read_proc_status(daemon.pid)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    loaded = [s for s in timeline if s["clients"] == args.clients] or timeline
+    return {
+        "config": {"clients": args.clients, "ramp_s": args.ramp_s,
+                   "duration_s": args.duration_s, "mix": weights},
+        "timeline": timeline,
+        "summary": {
+            name: {
+                "count": len(latencies[name]),
+                "errors": errors[name],
+                "ops_per_s": len(latencies[name]) / (args.ramp_s + args.duration_s),
+                "p50_ms": _percentile(latencies[name], 0.5) * 1e3,
+                "p99_ms": _percentile(latencies[name], 0.99) * 1e3,
+            }
+            for name in weights
+        },
+        "errors": error_samples,
+        "daemon": {
+            "rss_kb_start_of_load": loaded[0]["rss_kb"] if loaded else 0,
+            "rss_kb_end_of_load": loaded[-1]["rss_kb"] if loaded else 0,
+            "max_threads": max((s["threads"] for s in timeline), default=0),
+            "threads_when_idle": idle["threads"],
+        },
+        "keystore": _check_keystore(added, [file for (file, _) in shared]),
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Drives concurrent load against a local fstoken daemon")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--ramp-s", type=float, default=5.0)
+    parser.add_argument("--duration-s", type=float, default=15.0)
+    parser.add_argument("--mix", default="add=1,rotate=1,delegate=2,read=5,write=1")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Enable daemon metrics during the run")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    with TemporaryDirectory(prefix="fstoken-load-") as tmp:
+        workdir = Path(tmp)
+        environ["FSTOKEN_KEYSTORE_PATH"] = str(workdir / "keystore.db")
+        environ["FSTOKEN_SOCK_ADDRESS"] = str(workdir / "fstokend.sock")
+        if args.metrics:
+            environ["FSTOKEN_METRICS"] = "1"
+        (workdir / "keystore.db").touch()
+
+        # Makes src/ importable, only once the environment points to workdir
+        import _support
+        report = run(args, workdir)
+
+    output = dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+    keystore = report["keystore"]
+    consistent = not (keystore["invalid_lines"] or keystore["duplicated_paths"]
+                      or keystore["missing_added"] or keystore["missing_shared"]
+                      or keystore["unreadable"])
+    exit(0 if consistent else 1)
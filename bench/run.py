@@ -0,0 +1,127 @@
+"""
+Runs the fstoken benchmark suite offline, against a temporary directory
+holding the keystore, the daemon socket and the benchmarked files.
+
+    python bench/run.py [--full] [--only keystore,token]
+                        [--output results.json] [--baseline old.json]
+
+Results are written as JSON. Given a baseline, metrics that got worse
+by more than the threshold are reported and the run exits with 1.
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from importlib import import_module
+from json import dumps, loads
+from os import environ
+from pathlib import Path
+from platform import platform, python_version
+from sys import exit, stderr
+from tempfile import TemporaryDirectory
+
+SUITES = ["startup", "keystore", "token", "crypto", "daemon"]
+
+
+def _configure_paths(workdir: Path) -> None:
+    # Must happen before src modules are imported, they read it once
+    environ["FSTOKEN_KEYSTORE_PATH"] = str(workdir / "keystore.db")
+    environ["FSTOKEN_SOCK_ADDRESS"] = str(workdir / "fstokend.sock")
+    (workdir / "keystore.db").touch()
+
+
+def _run_startup(full: bool) -> list[dict]:
+    from _support import result
+    from startup import measure
+
+    startup = measure(runs=20 if full else 5)
+    return [result("cli.startup", {}, {
+        "import_ms": startup["import_ms_median"],
+        "import_p90_ms": startup["import_ms_p90"],
+    })]
+
+
+def _metric_direction(metric: str) -> int:
+    if metric.endswith("_per_s"):
+        return 1
+    if metric.endswith(("_us", "_ms")) or metric == "error_rate":
+        return -1
+
+    return 0
+
+
+def _result_key(result: dict) -> str:
+    return result["name"] + dumps(result["params"], sort_keys=True)
+
+
+def compare(results: list[dict], baseline: list[dict], threshold: float) -> int:
+    baseline_by_key = {_result_key(r): r for r in baseline}
+
+    regressions = 0
+    for result in results:
+        previous = baseline_by_key.get(_result_key(result))
+        if previous is None:
+            continue
+
+        for (metric, value) in result.items():
+            direction = _metric_direction(metric)
+            if not direction or not previous.get(metric):
+                continue
+
+            change = (value - previous[metric]) / previous[metric]
+            regressed = change * direction < -threshold
+            regressions += 1 if regressed else 0
+            print(f"{'REGRESSION' if regressed else 'ok':<10} "
+                  f"{result['name']} {dumps(result['params'])} {metric}: "
+                  f"{previous[metric]:.2f} -> {value:.2f} ({change:+.1%})",
+                  file=stderr)
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Runs the fstoken benchmark suite")
+    parser.add_argument("--full", action="store_true",
+                        help="Use the large sizes, e.g. 10^6 keystore entries")
+    parser.add_argument("--only", default=",".join(SUITES))
+    parser.add_argument("--output", default="")
+    parser.add_argument("--baseline", default="")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Relative change reported as a regression")
+    args = parser.parse_args()
+
+    suites = [suite for suite in args.only.split(",") if suite]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"Unknown suites {sorted(unknown)}, available: {SUITES}")
+
+    results = []
+    with TemporaryDirectory(prefix="fstoken-bench-") as tmp:
+        workdir = Path(tmp)
+        _configure_paths(workdir)
+
+        for suite in suites:
+            print(f"Running {suite} benchmarks", file=stderr)
+            if suite == "startup":
+                results += _run_startup(args.full)
+                continue
+
+            results += import_module(f"bench_{suite}").run(args.full, workdir)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": python_version(),
+            "platform": platform(),
+            "full": args.full,
+        },
+        "results": results,
+    }
+
+    output = dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        baseline = loads(Path(args.baseline).read_text())["results"]
+        exit(1 if compare(results, baseline, args.threshold) else 0)
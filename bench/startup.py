@@ -0,0 +1,73 @@
+"""
+Tracks the import time of the cli entry point against a budget.
+
+Each run spawns a fresh interpreter with -X importtime, so results
+include every module pulled in by "import cli". Modules that must stay
+lazy on the client side are reported when loaded eagerly.
+"""
+from argparse import ArgumentParser
+from json import dumps
+from statistics import median, quantiles
+from subprocess import run
+from sys import executable, exit
+
+from _support import SRC_DIR
+
+IMPORT_BUDGET_MS = 50.0
+# Daemon-only modules, the cli must never load them
+LAZY_MODULES = ("nacl", "ctypes", "daemon", "traceback", "batch", "cache", "captoken",
+                "codec", "crypto", "json", "keystore", "lock", "lzma", "metrics",
+                "watcher", "zstandard")
+
+
+def _parse_importtime(stderr: str) -> tuple[float, list[str]]:
+    total_ms = 0.0
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        (_, cumulative, name) = line.split("|")
+        name = name.strip()
+        if not cumulative.strip().isdigit():
+            continue
+
+        modules.append(name)
+        if name == "cli":
+            total_ms = int(cumulative) / 1000
+
+    return total_ms, modules
+
+
+def measure(runs: int) -> dict:
+    import_times = []
+    eager = set()
+    for _ in range(runs):
+        result = run([executable, "-X", "importtime", "-c", "import cli"],
+                     cwd=SRC_DIR, capture_output=True, text=True, check=True)
+        (total_ms, modules) = _parse_importtime(result.stderr)
+        import_times.append(total_ms)
+        eager.update(m for m in modules if m.split(".")[0] in LAZY_MODULES)
+
+    return {
+        "benchmark": "cli_startup",
+        "runs": runs,
+        "import_ms_median": median(import_times),
+        "import_ms_p90": quantiles(import_times, n=10)[-1] if runs > 1 else import_times[0],
+        "eager_lazy_modules": sorted(eager),
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Measures fstoken cli import time")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    args = parser.parse_args()
+
+    result = measure(args.runs)
+    result["budget_ms"] = args.budget_ms
+    result["within_budget"] = result["import_ms_median"] <= args.budget_ms \
+        and not result["eager_lazy_modules"]
+    print(dumps(result, indent=2))
+
+    exit(0 if result["within_budget"] else 1)
@@ -0,0 +1,159 @@
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps, loads, JSONDecodeError
+from sys import stdin
+
+from client import Client
+from operation import BaseOp, Add, Delegate, Delete, Read, Batch
+from helpers import Message, log, try_resolve_file
+
+
+class BatchRunner:
+    """
+    Runs the operations listed in a JSON lines manifest, e.g.
+    {"op": "delegate", "file": "notes.txt", "grant": "r", "key": "..."}.
+    Unprivileged steps run concurrently, privileged ones are sent to
+    the daemon as a single batch, and one JSON result line is printed
+    per manifest item, in manifest order. A path used again after its
+    deletion starts a new batch, so the revocation comes in between.
+    """
+    MAX_WORKERS = 8
+    _OPERATIONS = {
+        "add": Add,
+        "encrypt": Add,
+        "delegate": Delegate,
+        "invoke-read": Read,
+        "delete": Delete,
+    }
+
+    @staticmethod
+    def _read_manifest(source: str) -> list[str]:
+        if source == "-":
+            return stdin.readlines()
+
+        with open(source, "r") as manifest:
+            return manifest.readlines()
+
+    @staticmethod
+    def _build_args(item: dict, file: str) -> Namespace:
+        return Namespace(file=file,
+                         keygen=False,
+                         encrypt=item.get("encrypt", item["op"] == "encrypt"),
+                         rotate=item.get("rotate", False),
+                         delete=item["op"] == "delete",
+                         grant=item.get("grant", []),
+                         key=item.get("key", ""),
+                         token=item.get("token", ""),
+                         cache=item.get("cache", False),
+                         compress=item.get("compress", ""),
+                         stats=False,
+                         batch="")
+
+    @classmethod
+    def _parse_item(cls, line: str) -> tuple[dict, BaseOp | None, str]:
+        try:
+            item = loads(line)
+        except JSONDecodeError as err:
+            return {}, None, f"Invalid manifest line: {err}"
+
+        if not isinstance(item, dict) or item.get("op") not in cls._OPERATIONS:
+            return {}, None, \
+                f"Invalid operation, must be one of: {list(cls._OPERATIONS)}"
+
+        file = try_resolve_file(str(item.get("file", "")))
+        if not file:
+            return item, None, f"File {item.get('file')} could not be found"
+
+        args = cls._build_args(item, file)
+        # Same rule as OperationRegistry, a delegation needs both
+        if item["op"] == "delegate" and not (args.grant and args.key):
+            return item, None, "Delegation requires a grant and a key"
+
+        op_class = cls._OPERATIONS[item["op"]]
+        return item, op_class(args), ""
+
+    @staticmethod
+    def _run_unpriviledged(operation: BaseOp) -> str:
+        # A failing item must not abort the others, as on the daemon side
+        try:
+            return operation.run_unpriviledged()
+        except Exception as err:
+            return f"Unexpected runtime error: {repr(err)}"
+
+    @staticmethod
+    def _format_result(index: int, item: dict, result: Message) -> str:
+        return dumps({
+            "line": index + 1,
+            "op": item.get("op", ""),
+            "file": item.get("file", ""),
+            "ok": not result.err,
+            "payload": result.get_exposable_payload(),
+            "err": str(result.err) if result.err else "",
+        })
+
+    @staticmethod
+    def _split_rounds(parsed: list[tuple], pending: list[int]) -> list[list[int]]:
+        rounds = [[]]
+        deleted = set()
+        for idx in pending:
+            (item, op, _) = parsed[idx]
+            file = try_resolve_file(str(item["file"]))
+            if file in deleted:
+                rounds.append([])
+                deleted = set()
+
+            rounds[-1].append(idx)
+            if isinstance(op, Delete):
+                deleted.add(file)
+
+        return rounds
+
+    @classmethod
+    def _run_round(cls,
+                   parsed: list[tuple],
+                   pending: list[int],
+                   results: list[Message | None]) -> None:
+        # Deletions revoke access only after the daemon restored the file
+        first_unpriv = [idx for idx in pending
+                        if not isinstance(parsed[idx][1], Delete)]
+        with ThreadPoolExecutor(max_workers=cls.MAX_WORKERS) as pool:
+            unpriv_errs = pool.map(lambda idx: cls._run_unpriviledged(parsed[idx][1]),
+                                   first_unpriv)
+            for (idx, unpriv_err) in zip(first_unpriv, unpriv_errs):
+                if unpriv_err:
+                    results[idx] = Message(payload=None, err=unpriv_err)
+
+        priviledged = [idx for idx in pending if results[idx] is None]
+        batch = Batch(Namespace(), [parsed[idx][1] for idx in priviledged])
+        batch_result = Client.call_daemon_batch(batch) if priviledged \
+            else Message(payload=[], err="")
+
+        for (position, idx) in enumerate(priviledged):
+            results[idx] = Message(payload=None, err=batch_result.err) \
+                if batch_result.err else batch_result.payload[position]
+
+        last_unpriv = [idx for idx in priviledged
+                       if isinstance(parsed[idx][1], Delete) and not results[idx].err]
+        with ThreadPoolExecutor(max_workers=cls.MAX_WORKERS) as pool:
+            unpriv_errs = pool.map(lambda idx: cls._run_unpriviledged(parsed[idx][1]),
+                                   last_unpriv)
+            for (idx, unpriv_err) in zip(last_unpriv, unpriv_errs):
+                if unpriv_err:
+                    results[idx] = Message(payload=None, err=unpriv_err)
+
+    @classmethod
+    def run(cls, source: str) -> int:
+        parsed = [cls._parse_item(line)
+                  for line in cls._read_manifest(source) if line.strip()]
+
+        results = [Message(payload=None, err=parse_err) if parse_err else None
+                   for (_, _, parse_err) in parsed]
+        pending = [idx for (idx, (_, op, _)) in enumerate(parsed) if op]
+
+        for round_pending in cls._split_rounds(parsed, pending):
+            cls._run_round(parsed, round_pending, results)
+
+        for (idx, result) in enumerate(results):
+            log(cls._format_result(idx, parsed[idx][0], result))
+
+        return 0 if all(not result.err for result in results) else 1
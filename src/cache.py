@@ -0,0 +1,139 @@
+from collections import OrderedDict
+from ctypes import CDLL, addressof, c_char, c_size_t, c_void_p, get_errno
+from mmap import mmap
+from os import stat, strerror
+from threading import Lock
+
+
+class _LockedBuffer:
+    """
+    Holds plaintext in an anonymous mapping pinned with mlock(2),
+    so cached content is never written to swap. The mapping is
+    zeroed before being released.
+    """
+    # The process own symbol table already exposes libc
+    _libc = CDLL(None, use_errno=True)
+
+    def __init__(self, content: bytes):
+        self._size = len(content)
+        self._map = mmap(-1, max(self._size, 1))
+
+        if self._libc.mlock(self._get_address(), c_size_t(len(self._map))) != 0:
+            errno = get_errno()
+            self._map.close()
+            raise OSError(errno, strerror(errno))
+
+        self._map.write(content)
+
+    def _get_address(self) -> c_void_p:
+        return c_void_p(addressof(c_char.from_buffer(self._map)))
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def read(self) -> bytes:
+        return self._map[:self._size]
+
+    def release(self) -> None:
+        self._map.seek(0)
+        self._map.write(bytes(len(self._map)))
+        self._libc.munlock(self._get_address(), c_size_t(len(self._map)))
+        self._map.close()
+
+
+class ContentCache:
+    """
+    Bounded LRU cache of decrypted file contents kept by the daemon.
+    Entries are validated against the file inode, mtime, size and
+    filekey, so edits made outside fstoken and key rotations are
+    never served from the cache.
+    """
+    BUDGET_BYTES = 32 * 1024 * 1024
+
+    _entries: OrderedDict[str, tuple[tuple, _LockedBuffer]] = OrderedDict()
+    _lock = Lock()
+    _used_bytes = 0
+    _hits = 0
+    _misses = 0
+    _lock_failures = 0
+
+    @staticmethod
+    def _get_validator(file: str, filekey: str) -> tuple:
+        file_stat = stat(file)
+        return (file_stat.st_ino,
+                file_stat.st_mtime_ns,
+                file_stat.st_size,
+                filekey)
+
+    @classmethod
+    def _evict(cls, file: str) -> None:
+        (_, buffer) = cls._entries.pop(file)
+        cls._used_bytes -= buffer.size
+        buffer.release()
+
+    @classmethod
+    def _store(cls, file: str, validator: tuple, content: bytes) -> None:
+        if len(content) > cls.BUDGET_BYTES:
+            return
+
+        try:
+            buffer = _LockedBuffer(content)
+        except OSError:
+            cls._lock_failures += 1
+            return
+
+        while cls._entries and cls._used_bytes + buffer.size > cls.BUDGET_BYTES:
+            cls._evict(next(iter(cls._entries)))
+
+        cls._entries[file] = (validator, buffer)
+        cls._used_bytes += buffer.size
+
+    @classmethod
+    def get_or_load(cls,
+                    file: str,
+                    filekey: str,
+                    load_fn: callable) -> str:
+        # Validator is taken before loading: a concurrent change makes
+        # the stored entry stale instead of serving outdated content
+        validator = cls._get_validator(file, filekey)
+
+        with cls._lock:
+            cached = cls._entries.get(file)
+            if cached is not None and cached[0] == validator:
+                cls._entries.move_to_end(file)
+                cls._hits += 1
+                return cached[1].read().decode("utf-8")
+
+            cls._misses += 1
+            if cached is not None:
+                cls._evict(file)
+
+        content = load_fn()
+
+        with cls._lock:
+            if file in cls._entries:
+                cls._evict(file)
+            cls._store(file, validator, content.encode("utf-8"))
+
+        return content
+
+    @classmethod
+    def invalidate(cls, file: str) -> None:
+        with cls._lock:
+            if file in cls._entries:
+                cls._evict(file)
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        with cls._lock:
+            lookups = cls._hits + cls._misses
+            return {
+                "hits": cls._hits,
+                "misses": cls._misses,
+                "hit_ratio": cls._hits / lookups if lookups else 0.0,
+                "entries": len(cls._entries),
+                "used_bytes": cls._used_bytes,
+                "budget_bytes": cls.BUDGET_BYTES,
+                "lock_failures": cls._lock_failures,
+            }
@@ -1,9 +1,12 @@
 from base64 import b64encode, b64decode
 from pickle import dumps, loads
 from enum import Enum
+from collections import OrderedDict
+from threading import Lock
 
 from crypto import NaclBinder
 from helpers import remove_whitespace_newline
+from metrics import timed_phase
 
 
 class Grants(Enum):
@@ -56,10 +59,22 @@ class Token:
         ("proof", list)
     ]
 
+    _optional_raw_payload_fields = [
+        ("scope", str)
+    ]
+    _VALIDATION_CACHE_SIZE = 4096
+    _validation_cache: OrderedDict[tuple[str, str, str], Grants] = OrderedDict()
+    _validation_cache_lock = Lock()
+
     @staticmethod
-    def _get_file_designator_hash(filekey: str, grant: str) -> str:
+    def _get_file_designator_hash(filekey: str,
+                                  grant: str,
+                                  scope: str = "") -> str:
         key = remove_whitespace_newline(filekey)
         designator = f"{key}.{grant}"
+        # Directory tokens bind the path prefix they cover
+        if scope:
+            designator += f".{scope}"
 
         return \
             NaclBinder.sha256_hash(designator.encode("utf-8")).decode("utf-8")
@@ -88,11 +103,13 @@ class Token:
     @classmethod
     def _validate_file_designator(cls,
                                   designator: str,
-                                  filekey: str) -> Grants:
+                                  filekey: str,
+                                  scope: str) -> Grants:
         authorized_grant = None
         for grant in Grants.__iter__():
             hashed = cls._get_file_designator_hash(filekey,
-                                                   repr(grant))
+                                                   repr(grant),
+                                                   scope)
             if not hashed == designator:
                 continue
 
@@ -111,9 +128,16 @@ class Token:
         assert grant is not None, \
             f"Invalid grant for file, must be: {Grants.get_available_names()}"
 
+        scope = raw_payload.get("scope", "")
+        if scope:
+            cls._validate_payload_fields(raw_payload,
+                                         cls._optional_raw_payload_fields)
+
         processed_payload = {
             "file_designator": \
-                cls._get_file_designator_hash(raw_payload["filekey"], repr(grant)),
+                cls._get_file_designator_hash(raw_payload["filekey"],
+                                              repr(grant),
+                                              scope),
             "proof": raw_payload["proof"]
         }
 
@@ -133,10 +157,12 @@ class Token:
         return f"{public_key}.{payload}.{signature}"
 
     @classmethod
+    @timed_phase("token")
     def validate(cls,
                  token: str,
                  grant: Grants | None,
-                 filekey: str) -> Grants:
+                 filekey: str,
+                 scope: str = "") -> Grants:
         if token == "":
             return grant
 
@@ -148,8 +174,34 @@ class Token:
         cls._validate_payload_fields(payload, cls._processed_payload_fields)
 
         designator = payload["file_designator"]
-        grant = cls._validate_file_designator(designator, filekey)
+        grant = cls._validate_file_designator(designator, filekey, scope)
 
         next_token = next((t for t in payload["proof"] if t != token), "")
-        return cls.validate(next_token, grant, filekey)
+        return cls.validate(next_token, grant, filekey, scope)
+
+    @classmethod
+    @timed_phase("token")
+    def validate_cached(cls, token: str, filekey: str, scope: str = "") -> Grants:
+        """
+        Validates the whole token chain once per (token, key, scope),
+        so a directory token is verified a single time for every file
+        beneath it. Rotating the key changes the lookup and drops
+        the previous results.
+        """
+        cache_key = (token, filekey, scope)
+        with cls._validation_cache_lock:
+            grant = cls._validation_cache.get(cache_key)
+            if grant is not None:
+                cls._validation_cache.move_to_end(cache_key)
+                return grant
+
+        initial_grant = None
+        grant = cls.validate(token, initial_grant, filekey, scope)
+
+        with cls._validation_cache_lock:
+            cls._validation_cache[cache_key] = grant
+            if len(cls._validation_cache) > cls._VALIDATION_CACHE_SIZE:
+                cls._validation_cache.popitem(last=False)
+
+        return grant
 
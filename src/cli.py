@@ -1,16 +1,8 @@
 from argparse import ArgumentParser, Namespace
-from pathlib import Path
 
-from daemon import Client
+from client import Client
 from operation import OperationRegistry, Delete
-from helpers import log, log_err, keygen
-
-
-def _try_resolve_file(file: str) -> str:
-    try:
-        return str(Path(file).resolve(strict=True))
-    except OSError:
-        return ""
+from helpers import log, log_err, keygen, try_resolve_file
 
 
 def handle_call(args: Namespace) -> None:
@@ -18,10 +10,23 @@ def handle_call(args: Namespace) -> None:
         print(keygen())
         exit(0)
 
+    if args.stats:
+        op = OperationRegistry.get_operation_by_args(args)
+        call_result = Client.call_daemon(op)
+        log_err(call_result.err)
+        log(call_result.payload)
+        exit(0)
+
+    if args.batch:
+        # Batch mode pulls in a thread pool and json, single calls never do
+        from batch import BatchRunner
+
+        exit(BatchRunner.run(args.batch))
+
     if not args.file:
         log_err("File argument is required for this action")
         exit(1)
-    file = _try_resolve_file(args.file[0])
+    file = try_resolve_file(args.file[0])
     if not file:
         log_err(f"File {args.file} could not be found")
         exit(1)
@@ -56,9 +61,14 @@ if __name__ == "__main__":
     parser.add_argument("--encrypt", "-e", action="store_true")
     parser.add_argument("--rotate", "-r", action="store_true")
     parser.add_argument("--delete", "-d", action="store_true")
-    parser.add_argument("--grant", "-g", default="")
+    parser.add_argument("--grant", "-g", action="append", default=[])
     parser.add_argument("--key", "-k", default="")
     parser.add_argument("--token", "-t", default="")
+    parser.add_argument("--cache", "-c", action="store_true")
+    parser.add_argument("--compress", "-z", default="")
+    parser.add_argument("--stats", action="store_true")
+    parser.add_argument("--batch", "-b", default="",
+                        help="JSON lines manifest of operations, - for stdin")
     args = parser.parse_args()
 
     handle_call(args)
@@ -0,0 +1,105 @@
+from os import environ
+from socket import socket, AF_UNIX, SOCK_STREAM
+from struct import pack, unpack
+
+from helpers import Message
+
+# Same as typing.TYPE_CHECKING, without importing typing on every cli call
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from operation import BaseOp
+
+
+class _SocketMessageBroker:
+    _LENGTH_HEADER_SIZE = 4
+    _LENGTH_HEADER_FORMAT = "!I"
+
+    @classmethod
+    def get_message(cls, conn: socket) -> Message:
+        msg_length_bytes = b""
+        failed_read = False
+        while len(msg_length_bytes) < cls._LENGTH_HEADER_SIZE:
+            expected_read_size = cls._LENGTH_HEADER_SIZE - len(msg_length_bytes)
+            length_bytes = conn.recv(expected_read_size)
+
+            if not length_bytes:
+                failed_read = True
+
+            msg_length_bytes += length_bytes
+
+        if failed_read:
+            return Message(payload=None, err="Failed to read message")
+
+        msg_length = unpack(cls._LENGTH_HEADER_FORMAT, msg_length_bytes)[0]
+
+        # Large messages, e.g. batch results, arrive over several reads
+        msg_chunks = []
+        remaining = msg_length
+        while remaining > 0:
+            chunk = conn.recv(remaining)
+            if not chunk:
+                return Message(payload=None, err="Failed to read message")
+
+            msg_chunks.append(chunk)
+            remaining -= len(chunk)
+
+        return Message.from_bytes(b"".join(msg_chunks))
+
+    @classmethod
+    def send_message(cls, conn: socket, message: Message) -> None:
+        msg = bytes()
+        try:
+            msg = bytes(message)
+        except Exception as err:
+            msg = bytes(Message(payload=None,
+                                err=f"Failed to get message bytes: {repr(err)}"))
+
+        msg_length = pack(cls._LENGTH_HEADER_FORMAT, len(msg))
+        conn.sendall(msg_length + msg)
+
+
+class Client:
+    SOCK_ADDRESS = environ.get("FSTOKEN_SOCK_ADDRESS",
+                               "/run/fstokend/fstokend.sock")
+
+    @classmethod
+    def _call(cls, operation: "BaseOp") -> Message:
+        with socket(AF_UNIX, SOCK_STREAM) as conn:
+            conn.connect(cls.SOCK_ADDRESS)
+            _SocketMessageBroker.send_message(conn, Message(operation, ""))
+
+            daemon_msg = _SocketMessageBroker.get_message(conn)
+
+            op_result = daemon_msg
+            if operation.INTERACTIVE and not op_result.err:
+                prompt_result = \
+                    operation.prompt_user_with_file_editor(daemon_msg)
+
+                _SocketMessageBroker.send_message(conn, prompt_result)
+
+                op_result = prompt_result
+
+            return Message(payload=op_result.get_exposable_payload(),
+                           err=op_result.err)
+
+    @classmethod
+    def call_daemon(cls, operation: "BaseOp") -> Message:
+        try:
+            call_result = cls._call(operation)
+        except ConnectionError:
+            return Message(payload="", err="Failed to connect with fstoken daemon")
+
+        return call_result
+
+    @classmethod
+    def call_daemon_batch(cls, batch: "BaseOp") -> Message:
+        # Results are handed back as a list of messages, one per operation
+        try:
+            with socket(AF_UNIX, SOCK_STREAM) as conn:
+                conn.connect(cls.SOCK_ADDRESS)
+                _SocketMessageBroker.send_message(conn, Message(batch, ""))
+
+                return _SocketMessageBroker.get_message(conn)
+        except OSError:
+            # Also covers a missing socket, the daemon not running
+            return Message(payload=None, err="Failed to connect with fstoken daemon")
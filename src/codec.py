@@ -0,0 +1,51 @@
+from lzma import LZMACompressor, LZMADecompressor
+from zlib import compressobj, decompressobj
+
+from metrics import timed_phase
+
+try:
+    from zstandard import ZstdCompressor, ZstdDecompressor
+except ImportError:
+    ZstdCompressor = ZstdDecompressor = None
+
+
+class Codec:
+    """
+    Compression applied to file contents before encryption. SecretBox
+    seals a file as a single message, so contents are (de)compressed in
+    one shot and held in memory whole, as both input and output.
+    """
+    _COMPRESSORS = {
+        "zlib": compressobj,
+        "lzma": LZMACompressor,
+    }
+    _DECOMPRESSORS = {
+        "zlib": decompressobj,
+        "lzma": LZMADecompressor,
+    }
+    if ZstdCompressor is not None:
+        _COMPRESSORS["zstd"] = lambda: ZstdCompressor().compressobj()
+        _DECOMPRESSORS["zstd"] = lambda: ZstdDecompressor().decompressobj()
+
+    @classmethod
+    def get_available_algorithms(cls) -> list[str]:
+        return list(cls._COMPRESSORS.keys())
+
+    @classmethod
+    @timed_phase("compression")
+    def compress(cls, algorithm: str, data: bytes) -> bytes:
+        compressor = cls._COMPRESSORS[algorithm]()
+        return b"".join([compressor.compress(data), compressor.flush()])
+
+    @classmethod
+    @timed_phase("compression")
+    def decompress(cls, algorithm: str, data: bytes) -> bytes:
+        decompressor = cls._DECOMPRESSORS[algorithm]()
+        decompressed = [decompressor.decompress(data)]
+
+        # lzma decompressors have nothing left to flush
+        flush = getattr(decompressor, "flush", None)
+        if flush is not None:
+            decompressed.append(flush())
+
+        return b"".join(decompressed)
@@ -1,11 +1,14 @@
-from nacl.signing import SigningKey, VerifyKey
-from nacl.public import PrivateKey
 from nacl.encoding import Base64Encoder
-from nacl.exceptions import BadSignatureError
-from nacl.hash import sha256
+from nacl.hash import blake2b, sha256
 from nacl.secret import SecretBox
+from nacl.signing import SigningKey, VerifyKey
 from nacl.utils import random
 
+from metrics import timed_phase
+
+# Loading the PyNaCl bindings dominates startup, the cli only imports
+# this module lazily, e.g. for --keygen.
+
 
 class NaclBinder:
     @staticmethod
@@ -35,12 +38,23 @@ class NaclBinder:
         return Base64Encoder.encode(key)
 
     @staticmethod
+    @timed_phase("crypto")
+    def secretbox_derive_key(b64key: bytes, context: bytes) -> bytes:
+        key = Base64Encoder.decode(b64key)
+        return blake2b(context,
+                       digest_size=SecretBox.KEY_SIZE,
+                       key=key,
+                       person=b"fstoken-subkey",
+                       encoder=Base64Encoder)
+
+    @staticmethod
+    @timed_phase("crypto")
     def secretbox_encrypt(b64key: bytes, raw: bytes) -> bytes:
         box = SecretBox(b64key, encoder=Base64Encoder)
         return box.encrypt(raw)
 
     @staticmethod
+    @timed_phase("crypto")
     def secretbox_decrypt(b64key: bytes, encrypted: bytes) -> bytes:
         box = SecretBox(b64key, encoder=Base64Encoder)
         return box.decrypt(encrypted)
-
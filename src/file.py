@@ -1,32 +1,52 @@
 from pathlib import Path
-from os import access, W_OK, X_OK
+from os import access, getuid, getxattr, lstat, walk, R_OK, W_OK, X_OK
+from os.path import join
+from pwd import getpwnam
+from struct import iter_unpack, error as StructError
 from subprocess import run, CalledProcessError
 from functools import partial
 
-from crypto import NaclBinder
+# Access checks and ACLs run in the cli, content is only rewritten by the
+# daemon: crypto, codecs and metrics are imported inside those methods.
 
 
 class  File:
     _FSTOKEN_USER = "fstoken"
+    _ACL_XATTR = "system.posix_acl_access"
+    _ACL_HEADER_SIZE = 4
+    _ACL_ENTRY_FORMAT = "<HHI"
+    _ACL_USER_TAG = 0x02
+    _ACL_RW_PERM = 0x06
 
     @staticmethod
     def _rewrite_file(filepath: Path, content_producer_fn: callable) -> None:
+        # Rewritten in place to keep the inode and its ACLs. The new content
+        # is fully produced first, so a failing decryption or decompression
+        # leaves the file untouched
         with open(filepath, "r+b") as file:
-            content = file.read()
-            file.seek(0)
-            file.truncate(0)
+            reprocessed = content_producer_fn(file.read())
 
-            reprocessed = content_producer_fn(content)
+            file.seek(0)
             file.write(reprocessed)
+            file.truncate()
 
     @staticmethod
-    def decrypt_to_read(file: str, b64key: bytes | str) -> str:
+    def decrypt_to_read(file: str,
+                        b64key: bytes | str,
+                        compression: str = "") -> str:
+        from crypto import NaclBinder
+        from codec import Codec
+        from metrics import Metrics
+
         filepath = Path(file)
-        with open(filepath, "rb") as file:
+        with Metrics.phase("file_io"), open(filepath, "rb") as file:
             encrypted = file.read()
 
-            return NaclBinder.secretbox_decrypt(b64key, encrypted) \
-                .decode("utf-8")
+            decrypted = NaclBinder.secretbox_decrypt(b64key, encrypted)
+            if compression:
+                decrypted = Codec.decompress(compression, decrypted)
+
+            return decrypted.decode("utf-8")
 
     @staticmethod
     def _get_accessible_candidates(file: str) -> list[str]:
@@ -43,17 +63,55 @@ class  File:
 
         return pathnames
 
+    @staticmethod
+    def _decrypt_and_decompress(b64key: bytes | str,
+                                compression: str,
+                                encrypted: bytes) -> bytes:
+        from crypto import NaclBinder
+        from codec import Codec
+
+        decrypted = NaclBinder.secretbox_decrypt(b64key, encrypted)
+        return Codec.decompress(compression, decrypted)
+
+    @staticmethod
+    def _compress_and_encrypt(b64key: bytes | str,
+                              compression: str,
+                              raw: bytes) -> bytes:
+        from crypto import NaclBinder
+        from codec import Codec
+
+        compressed = Codec.compress(compression, raw)
+        return NaclBinder.secretbox_encrypt(b64key, compressed)
+
     @classmethod
-    def decrypt(cls, file: str, b64key: bytes | str) -> None:
+    def decrypt(cls,
+                file: str,
+                b64key: bytes | str,
+                compression: str = "") -> None:
+        from crypto import NaclBinder
+        from metrics import Metrics
+
         filepath = Path(file)
         decrypt_fn = partial(NaclBinder.secretbox_decrypt, b64key)
-        cls._rewrite_file(filepath, decrypt_fn)
+        if compression:
+            decrypt_fn = partial(cls._decrypt_and_decompress, b64key, compression)
+        with Metrics.phase("file_io"):
+            cls._rewrite_file(filepath, decrypt_fn)
 
     @classmethod
-    def encrypt(cls, file: str, b64key: bytes | str) -> None:
+    def encrypt(cls,
+                file: str,
+                b64key: bytes | str,
+                compression: str = "") -> None:
+        from crypto import NaclBinder
+        from metrics import Metrics
+
         filepath = Path(file)
         encrypt_fn = partial(NaclBinder.secretbox_encrypt, b64key)
-        cls._rewrite_file(filepath, encrypt_fn)
+        if compression:
+            encrypt_fn = partial(cls._compress_and_encrypt, b64key, compression)
+        with Metrics.phase("file_io"):
+            cls._rewrite_file(filepath, encrypt_fn)
 
     @classmethod
     def _remove_dir_acls(cls, pathnames: list[str]) -> str:
@@ -69,9 +127,12 @@ class  File:
     def _add_dir_acls(cls, pathnames: list[str]) -> str:
         failed_index = 0
         for idx, p in enumerate(pathnames):
+            # The keystore watcher follows renames in the parent directory,
+            # inotify needs read access to watch it
+            perms = "rwx" if idx == 0 else "wx"
             try:
                 failed_index = idx
-                run(["setfacl", "-m", f"u:{cls._FSTOKEN_USER}:wx", p], check=True)
+                run(["setfacl", "-m", f"u:{cls._FSTOKEN_USER}:{perms}", p], check=True)
             except CalledProcessError:
                 grant_err = f"Failed to grant fstoken user access to: {p}"
                 removal_failure = cls._remove_dir_acls(pathnames[:failed_index])
@@ -83,16 +144,81 @@ class  File:
 
         return ""
 
+    @staticmethod
+    def _get_denied_subtree_path(directory: str) -> str:
+        # Directory keys cover every file beneath, each of them must be
+        # owned or readable by the requester, not only the directory
+        uid = getuid()
+        denied = []
+        tree = walk(directory, onerror=lambda err: denied.append(err.filename))
+        for (dirpath, dirnames, filenames) in tree:
+            for name in dirnames + filenames:
+                path = join(dirpath, name)
+                mode = R_OK | X_OK if name in dirnames else R_OK
+                try:
+                    if lstat(path).st_uid != uid and not access(path, mode):
+                        denied.append(path)
+                except OSError:
+                    denied.append(path)
+
+            if denied:
+                break
+
+        return denied[0] if denied else ""
+
     @classmethod
-    def grant_fstoken_access(cls, file: str) -> str:
+    def check_requester_access(cls, file: str) -> str:
+        if Path(file).is_dir():
+            if not access(file, R_OK | W_OK | X_OK):
+                return "User must have rwx access on directory to add it to fstoken"
+
+            denied_path = cls._get_denied_subtree_path(file)
+            if denied_path:
+                return f"User must own or be able to read everything in the directory, " \
+                       f"denied: {denied_path}"
+            return ""
+
         try:
             with open(file, "r+") as f:
                 pass
         except PermissionError:
             return "User must have rw- access on file to add it to fstoken"
 
+        return ""
+
+    @classmethod
+    def has_fstoken_access(cls, file: str) -> bool:
+        # Reads the access ACL straight from its xattr to avoid forking getfacl
         try:
-            run(["setfacl", "-m", f"u:{cls._FSTOKEN_USER}:rw-", file], check=True)
+            fstoken_uid = getpwnam(cls._FSTOKEN_USER).pw_uid
+            acl = getxattr(file, cls._ACL_XATTR)
+            entries = iter_unpack(cls._ACL_ENTRY_FORMAT,
+                                  acl[cls._ACL_HEADER_SIZE:])
+        except (KeyError, OSError, StructError):
+            return False
+
+        for (tag, perm, uid) in entries:
+            if tag == cls._ACL_USER_TAG and uid == fstoken_uid:
+                return perm & cls._ACL_RW_PERM == cls._ACL_RW_PERM
+
+        return False
+
+    @classmethod
+    def grant_fstoken_access(cls, file: str) -> str:
+        access_err = cls.check_requester_access(file)
+        if access_err:
+            return access_err
+
+        # Directories are granted recursively, default ACLs
+        # extend the grant to files created beneath them later
+        acl_cmd = ["setfacl", "-m", f"u:{cls._FSTOKEN_USER}:rw-", file]
+        if Path(file).is_dir():
+            acl_cmd = ["setfacl", "-R", "-m",
+                       f"u:{cls._FSTOKEN_USER}:rwX,d:u:{cls._FSTOKEN_USER}:rwX",
+                       file]
+
+        try:
+            run(acl_cmd, check=True)
         except CalledProcessError:
              return f"Failed to grant fstoken user access to: {file}"
 
@@ -106,9 +232,15 @@ class  File:
 
     @classmethod
     def revoke_fstoken_access(cls, file: str) -> str:
+        acl_cmd = ["setfacl", "-x", f"u:{cls._FSTOKEN_USER}", file]
+        if Path(file).is_dir():
+            acl_cmd = ["setfacl", "-R", "-x",
+                       f"u:{cls._FSTOKEN_USER},d:u:{cls._FSTOKEN_USER}",
+                       file]
+
         err_revocation = ""
         try:
-            run(["setfacl", "-x", f"u:{cls._FSTOKEN_USER}", file], check=True)
+            run(acl_cmd, check=True)
         except CalledProcessError:
             err_revocation = f"Failed to revoke fstoken user access to: {file}"
 
@@ -1,8 +1,6 @@
 from sys import stderr
-from typing import NewType
 from pickle import loads, dumps
-
-from crypto import NaclBinder
+from pathlib import Path
 
 
 def log(message: str) -> None:
@@ -18,9 +16,19 @@ def log_err(message: str) -> None:
 
 
 def keygen() -> str:
+    # Shared by the cli, which only needs crypto for --keygen
+    from crypto import NaclBinder
+
     return NaclBinder.secretbox_keygen().decode("utf-8")
 
 
+def try_resolve_file(file: str) -> str:
+    try:
+        return str(Path(file).resolve(strict=True))
+    except OSError:
+        return ""
+
+
 def remove_whitespace_newline(seq: str) -> str:
     return seq.strip().split("\n")[0]
 
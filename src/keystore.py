@@ -1,59 +1,169 @@
+from os import environ, fsync, open as os_open, replace, O_CREAT, O_TRUNC, O_WRONLY
 from pathlib import Path
+from threading import Lock
 
 from crypto import NaclBinder
 from helpers import keygen
+from metrics import timed_phase
 
 
 class Keystore:
     STORE_FILENAME = "keystore.db"
-    _KEYSTORE_PATH = Path("/opt/fstoken", STORE_FILENAME)
+    _KEYSTORE_PATH = Path(environ.get("FSTOKEN_KEYSTORE_PATH",
+                                      f"/opt/fstoken/{STORE_FILENAME}"))
     _ENTRY_DATA_SEP = "\t"
+    _ENTRY_FIELDS_COUNT = 4
+    _OPTIONS_SEP = ","
+    _OPTION_VALUE_SEP = "="
+    # Maintained by the daemon, never requested by users
+    INODE_OPTION = "ino"
+    TOMBSTONE_OPTION = "gone"
+    # Serializes read-modify-write cycles of the daemon request threads
+    _write_lock = Lock()
 
     @staticmethod
     def _get_filestring(file: str) -> str:
         return str(Path(file).resolve())
 
     @classmethod
-    def _create_entry_repr(cls, entry: tuple[str, str, str]) -> str:
-        (filestring, encstring, keystring) = entry
+    def _create_options_repr(cls, options: dict[str, str]) -> str:
+        return cls._OPTIONS_SEP.join(
+            f"{name}{cls._OPTION_VALUE_SEP}{value}"
+            for (name, value) in sorted(options.items())
+        )
 
-        return filestring \
-                + cls._ENTRY_DATA_SEP \
-                + encstring \
-                + cls._ENTRY_DATA_SEP \
-                + keystring \
-                + "\n"
+    @classmethod
+    def _parse_options(cls, optstring: str) -> dict[str, str]:
+        options = {}
+        for option in optstring.split(cls._OPTIONS_SEP):
+            (name, _, value) = option.partition(cls._OPTION_VALUE_SEP)
+            if name:
+                options[name] = value
+
+        return options
 
     @classmethod
-    def search_entry_state(cls, file: str) -> tuple[bool, str]:
-        with open(cls._KEYSTORE_PATH, "r") as ks:
-            entries = list(map(lambda line: line.split(cls._ENTRY_DATA_SEP),
-                               ks.readlines()))
+    def _create_entry_repr(cls, entry: tuple[str, str, str, str]) -> str:
+        return cls._ENTRY_DATA_SEP.join(entry) + "\n"
 
-            for entry in entries:
-                if len(entry) != 3:
-                    continue
-                (filestring, encstring, keystring) = entry
-                if filestring == cls._get_filestring(file):
-                    encrypted = True if encstring == "1" else False
-                    return encrypted, keystring
+    @classmethod
+    def _to_raw_entry(
+            cls,
+            entry: tuple[str, bool, str, dict[str, str]]) -> tuple[str, str, str, str]:
+        (filestring, encrypted, keystring, options) = entry
+
+        return (filestring,
+                "1" if encrypted else "0",
+                keystring,
+                cls._create_options_repr(options))
+
+    @classmethod
+    def _from_raw_entry(
+            cls,
+            entry: tuple[str, str, str, str]) -> tuple[str, bool, str, dict[str, str]]:
+        (filestring, encstring, keystring, optstring) = entry
+
+        return (filestring,
+                True if encstring == "1" else False,
+                keystring,
+                cls._parse_options(optstring))
+
+    @classmethod
+    def get_requested_options(cls, options: dict[str, str]) -> dict[str, str]:
+        return {name: value for (name, value) in options.items()
+                if name not in (cls.INODE_OPTION, cls.TOMBSTONE_OPTION)}
+
+    @classmethod
+    def _is_tombstoned(cls, optstring: str) -> bool:
+        # Cheap substring check first, most entries carry no tombstone
+        return f"{cls.TOMBSTONE_OPTION}{cls._OPTION_VALUE_SEP}" in optstring \
+            and cls.TOMBSTONE_OPTION in cls._parse_options(optstring)
+
+    @classmethod
+    def _parse_entry(cls, line: str) -> tuple[str, str, str, str] | None:
+        entry = line.rstrip("\n").split(cls._ENTRY_DATA_SEP)
+
+        # Entries written before options were introduced have no such field
+        if len(entry) == cls._ENTRY_FIELDS_COUNT - 1:
+            entry.append("")
+
+        if len(entry) != cls._ENTRY_FIELDS_COUNT:
+            return None
+
+        return tuple(entry)
+
+    @classmethod
+    @timed_phase("keystore")
+    def search_entry(cls, file: str) -> tuple[bool, str, dict[str, str]]:
+        filestring = cls._get_filestring(file)
+        for entry in cls._get_all_entries():
+            (entry_filestring, encstring, keystring, optstring) = entry
+            # Tombstoned entries lost their file, they cover nothing
+            if entry_filestring == filestring and not cls._is_tombstoned(optstring):
+                encrypted = True if encstring == "1" else False
+                return encrypted, keystring, cls._parse_options(optstring)
+
+        return False, "", {}
+
+    @classmethod
+    @timed_phase("keystore")
+    def search_scopes(cls,
+                      file: str) -> list[tuple[str, bool, str, dict[str, str]]]:
+        """
+        Returns the entries covering a file, from the most specific to
+        the least: the file own entry, if any, followed by every
+        enrolled directory above it.
+        """
+        filepath = Path(cls._get_filestring(file))
+        entries = {entry[0]: entry for entry in cls._get_all_entries()
+                   if not cls._is_tombstoned(entry[3])}
+
+        scopes = []
+        for candidate in [filepath, *filepath.parents]:
+            entry = entries.get(str(candidate))
+            if entry is None:
+                continue
+
+            (filestring, encstring, keystring, optstring) = entry
+            options = cls._parse_options(optstring)
+            if candidate != filepath and options.get("scope") != "dir":
+                continue
+
+            encrypted = True if encstring == "1" else False
+            scopes.append((filestring, encrypted, keystring, options))
 
-        return False, ""
+        return scopes
 
     @classmethod
-    def _append(cls, entry: tuple[str, str, str]) -> None:
+    def derive_filekey(cls, dirstring: str, dirkey: str, file: str) -> str:
+        relative = Path(cls._get_filestring(file)).relative_to(dirstring)
+        context = str(relative).encode("utf-8")
+
+        return NaclBinder.secretbox_derive_key(dirkey.encode("utf-8"), context) \
+            .decode("utf-8")
+
+    @classmethod
+    def search_entry_state(cls, file: str) -> tuple[bool, str]:
+        (encrypted, keystring, _) = cls.search_entry(file)
+
+        return encrypted, keystring
+
+    @classmethod
+    def _append(cls, entry: tuple[str, str, str, str]) -> None:
         with open(cls._KEYSTORE_PATH, "a") as ks:
             ks.write(cls._create_entry_repr(entry))
 
     @classmethod
-    def _get_all_entries(cls) -> list[tuple[str, str, str]]:
+    def _has_any_entry(cls, filestring: str) -> bool:
+        return any(entry[0] == filestring for entry in cls._get_all_entries())
+
+    @classmethod
+    def _get_all_entries(cls) -> list[tuple[str, str, str, str]]:
         all_entries = []
         with open(cls._KEYSTORE_PATH, "r") as ks:
-            entries = list(map(lambda l: l.split(cls._ENTRY_DATA_SEP),
-                               ks.readlines()))
-
-            for entry in entries:
-                if len(entry) != 3:
+            for line in ks.readlines():
+                entry = cls._parse_entry(line)
+                if entry is None:
                     continue
 
                 all_entries.append(entry)
@@ -62,37 +172,115 @@ class Keystore:
 
     @classmethod
     def _truncate_and_rewrite_lines(
-            cls, entries: list[tuple[str, str, str]]) -> None:
-        with open(cls._KEYSTORE_PATH, "w") as ks:
+            cls, entries: list[tuple[str, str, str, str]]) -> None:
+        # Readers keep seeing the previous keystore until it is replaced
+        tmp_path = cls._KEYSTORE_PATH.with_name(f"{cls._KEYSTORE_PATH.name}.tmp")
+        with open(os_open(tmp_path, O_WRONLY | O_CREAT | O_TRUNC, 0o600), "w") as ks:
             for entry in entries:
                 ks.write(cls._create_entry_repr(entry))
+            ks.flush()
+            fsync(ks.fileno())
+
+        replace(tmp_path, cls._KEYSTORE_PATH)
 
     @classmethod
+    @timed_phase("keystore")
     def change_entry(cls,
                      file: str,
                      encrypt: bool = False,
                      rotate_key: bool = False,
-                     delete: bool = False) -> str:
-        (_, current_key) = cls.search_entry_state(file)
-        entry_exists = current_key != ""
+                     delete: bool = False,
+                     options: dict[str, str] | None = None) -> str:
+        with cls._write_lock:
+            (_, current_key, current_options) = cls.search_entry(file)
+            entry_exists = current_key != ""
+
+            filekey = keygen() if rotate_key or not entry_exists else current_key
+            new_options = current_options if options is None else options
+            new_entry = (cls._get_filestring(file),
+                         "1" if encrypt else "0",
+                         filekey,
+                         cls._create_options_repr(new_options))
+
+            # A tombstone left at the path is replaced, not kept alongside
+            if not entry_exists and not cls._has_any_entry(new_entry[0]):
+                cls._append(new_entry)
 
-        filekey = keygen() if rotate_key or not entry_exists else current_key
-        new_entry = (cls._get_filestring(file), 
-                     "1" if encrypt else "0",
-                     filekey)
+                return filekey
 
-        if not entry_exists:
-            cls._append(new_entry)
+            new_entries = [er for er in cls._get_all_entries() \
+                           if er[0] != new_entry[0]]
+
+            if not delete:
+                new_entries.append(new_entry)
+
+            cls._truncate_and_rewrite_lines(new_entries)
 
             return filekey
 
-        new_entries = [er for er in cls._get_all_entries() \
-                       if er[0] != new_entry[0]]
+    @classmethod
+    def get_mtime(cls) -> int:
+        return cls._KEYSTORE_PATH.stat().st_mtime_ns
+
+    @classmethod
+    @timed_phase("keystore")
+    def list_entries(cls) -> list[tuple[str, bool, str, dict[str, str]]]:
+        return [cls._from_raw_entry(entry) for entry in cls._get_all_entries()]
+
+    @classmethod
+    @timed_phase("keystore")
+    def replace_entries(
+            cls,
+            replacements: dict[str, tuple[tuple, tuple]]) -> int:
+        """
+        Takes (seen, new) entry pairs keyed by path, as returned by
+        list_entries. Entries changed since they were seen are kept.
+        """
+        with cls._write_lock:
+            entries = cls.list_entries()
+
+            replaced = 0
+            for (idx, entry) in enumerate(entries):
+                (seen, new) = replacements.get(entry[0], (None, None))
+                if seen == entry:
+                    entries[idx] = new
+                    replaced += 1
+
+            if replaced:
+                cls._truncate_and_rewrite_lines(
+                    [cls._to_raw_entry(entry) for entry in entries])
 
-        if not delete:
-            new_entries.append(new_entry)
+            return replaced
+
+    @classmethod
+    @timed_phase("keystore")
+    def compact(cls, encrypted_tombstone_ttl_s: float, now: float) -> int:
+        """
+        Drops duplicated paths, unreadable lines and tombstones. Keys of
+        encrypted files are kept for a grace period, they are the only
+        way to recover a file moved back in place.
+        """
+        with cls._write_lock:
+            with open(cls._KEYSTORE_PATH, "r") as ks:
+                lines_count = sum(1 for line in ks if line.strip())
+
+            kept = {}
+            for entry in cls.list_entries():
+                (filestring, encrypted, _, options) = entry
+                gone = options.get(cls.TOMBSTONE_OPTION)
+                # The live entry of a path wins over its tombstones
+                if filestring in kept \
+                        and (gone or cls.TOMBSTONE_OPTION not in kept[filestring][3]):
+                    continue
+                if gone and (not encrypted
+                             or now - float(gone) > encrypted_tombstone_ttl_s):
+                    continue
 
-        cls._truncate_and_rewrite_lines(new_entries)
+                kept[filestring] = entry
 
-        return filekey
+            dropped = lines_count - len(kept)
+            if dropped:
+                cls._truncate_and_rewrite_lines(
+                    [cls._to_raw_entry(entry) for entry in kept.values()])
 
+            return dropped
@@ -0,0 +1,106 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+from threading import Condition, Lock
+from time import perf_counter
+
+
+class _ReadWriteLock:
+    """
+    Many readers or a single writer. Waiting writers block new
+    readers so a steady flow of reads cannot starve updates.
+    """
+    def __init__(self):
+        self._cond = Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    def acquire_read(self) -> None:
+        with self._cond:
+            while self._writing or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self) -> None:
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self) -> None:
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+
+    def release_write(self) -> None:
+        with self._cond:
+            self._writing = False
+            self._cond.notify_all()
+
+
+class PathLocks:
+    """
+    Per-path reader/writer locking for the daemon. Paths are hashed
+    onto a fixed set of stripes, so memory does not grow with the
+    number of files at the cost of unrelated paths occasionally
+    sharing a lock. Callers must not nest path locks.
+    """
+    STRIPES_COUNT = 64
+    READ = "read"
+    WRITE = "write"
+
+    _stripes = [_ReadWriteLock() for _ in range(STRIPES_COUNT)]
+    _stats_lock = Lock()
+    _wait_stats = {
+        mode: {"acquired": 0, "contended": 0, "wait_total_s": 0.0, "wait_max_s": 0.0}
+        for mode in (READ, WRITE)
+    }
+
+    @classmethod
+    def _get_stripe(cls, path: str) -> _ReadWriteLock:
+        return cls._stripes[hash(path) % cls.STRIPES_COUNT]
+
+    @classmethod
+    def _record_wait(cls, mode: str, waited: float) -> None:
+        with cls._stats_lock:
+            stats = cls._wait_stats[mode]
+            stats["acquired"] += 1
+            stats["wait_total_s"] += waited
+            stats["wait_max_s"] = max(stats["wait_max_s"], waited)
+            # Waits under a millisecond are uncontended acquisitions
+            if waited >= 1e-3:
+                stats["contended"] += 1
+
+    @classmethod
+    @contextmanager
+    def reading(cls, path: str) -> Iterator[None]:
+        stripe = cls._get_stripe(path)
+
+        start = perf_counter()
+        stripe.acquire_read()
+        cls._record_wait(cls.READ, perf_counter() - start)
+        try:
+            yield
+        finally:
+            stripe.release_read()
+
+    @classmethod
+    @contextmanager
+    def writing(cls, path: str) -> Iterator[None]:
+        stripe = cls._get_stripe(path)
+
+        start = perf_counter()
+        stripe.acquire_write()
+        cls._record_wait(cls.WRITE, perf_counter() - start)
+        try:
+            yield
+        finally:
+            stripe.release_write()
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        with cls._stats_lock:
+            return {mode: dict(stats) for (mode, stats) in cls._wait_stats.items()}
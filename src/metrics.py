@@ -0,0 +1,233 @@
+from collections.abc import Callable
+from functools import wraps
+from os import environ, replace
+from threading import Event, Lock, Thread, local
+from time import perf_counter
+
+
+class _OperationRecord:
+    __slots__ = ("name", "phases", "phase_stack", "failed")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.phases = dict.fromkeys(Metrics.PHASES, 0.0)
+        # Time spent in nested phases, one slot per open phase
+        self.phase_stack = []
+        self.failed = False
+
+
+class _NullRecord:
+    __slots__ = ("failed",)
+
+    def __enter__(self) -> "_NullRecord":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+
+class _OperationContext:
+    def __init__(self, name: str):
+        self._record = _OperationRecord(name)
+
+    def __enter__(self) -> _OperationRecord:
+        Metrics._get_records().append(self._record)
+        self._start = perf_counter()
+        return self._record
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        elapsed = perf_counter() - self._start
+        Metrics._get_records().pop()
+        if exc_type is not None:
+            self._record.failed = True
+
+        Metrics._record_operation(self._record, elapsed)
+
+
+class _PhaseContext:
+    def __init__(self, name: str):
+        self._name = name
+
+    def __enter__(self) -> None:
+        records = Metrics._get_records()
+        self._record = records[-1] if records else None
+        if self._record is not None:
+            self._record.phase_stack.append(0.0)
+        self._start = perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        if self._record is None:
+            return
+
+        elapsed = perf_counter() - self._start
+        nested = self._record.phase_stack.pop()
+        # Phases are exclusive: time in nested phases is not counted twice
+        self._record.phases[self._name] += elapsed - nested
+        if self._record.phase_stack:
+            self._record.phase_stack[-1] += elapsed
+
+
+class Metrics:
+    """
+    Per-operation counters, latency histograms, error counts and a
+    breakdown of where each operation spent its time. Enabled with
+    FSTOKEN_METRICS=1 when the daemon starts; otherwise phase
+    decorators return the functions untouched and operation contexts
+    are a shared no-op, so the instrumentation costs next to nothing.
+    """
+    ENABLED = environ.get("FSTOKEN_METRICS", "") == "1"
+    PROMETHEUS_FILE = environ.get("FSTOKEN_METRICS_FILE", "")
+    EXPORT_INTERVAL_S = 10.0
+    PHASES = ("keystore", "token", "crypto", "compression", "file_io")
+    LATENCY_BUCKETS_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                         0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    _NULL_RECORD = _NullRecord()
+    _local = local()
+    _lock = Lock()
+    _operations = {}
+
+    @classmethod
+    def _get_records(cls) -> list[_OperationRecord]:
+        records = getattr(cls._local, "records", None)
+        if records is None:
+            records = cls._local.records = []
+
+        return records
+
+    @classmethod
+    def _record_operation(cls, record: _OperationRecord, elapsed: float) -> None:
+        with cls._lock:
+            stats = cls._operations.get(record.name)
+            if stats is None:
+                stats = cls._operations[record.name] = {
+                    "count": 0,
+                    "errors": 0,
+                    "latency_sum_s": 0.0,
+                    # The last slot counts latencies above every bound
+                    "latency_buckets": [0] * (len(cls.LATENCY_BUCKETS_S) + 1),
+                    "phases_s": dict.fromkeys(cls.PHASES, 0.0),
+                }
+
+            stats["count"] += 1
+            stats["errors"] += 1 if record.failed else 0
+            stats["latency_sum_s"] += elapsed
+            for (idx, bound) in enumerate(cls.LATENCY_BUCKETS_S):
+                if elapsed <= bound:
+                    stats["latency_buckets"][idx] += 1
+                    break
+            else:
+                stats["latency_buckets"][-1] += 1
+            for (phase, spent) in record.phases.items():
+                stats["phases_s"][phase] += spent
+
+    @classmethod
+    def operation(cls, name: str) -> _OperationContext | _NullRecord:
+        if not cls.ENABLED:
+            return cls._NULL_RECORD
+
+        return _OperationContext(name)
+
+    @classmethod
+    def phase(cls, name: str) -> _PhaseContext | _NullRecord:
+        if not cls.ENABLED:
+            return cls._NULL_RECORD
+
+        return _PhaseContext(name)
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        if not cls.ENABLED:
+            return {"enabled": False}
+
+        with cls._lock:
+            operations = {}
+            for (name, stats) in cls._operations.items():
+                operations[name] = {
+                    "count": stats["count"],
+                    "errors": stats["errors"],
+                    "latency_avg_s": stats["latency_sum_s"] / stats["count"],
+                    "latency_buckets_s": dict(zip([*map(str, cls.LATENCY_BUCKETS_S), "+Inf"],
+                                                  stats["latency_buckets"])),
+                    "phases_s": dict(stats["phases_s"]),
+                }
+
+        return {"enabled": True, "operations": operations}
+
+    @classmethod
+    def _format_prometheus(cls) -> str:
+        with cls._lock:
+            operations = sorted((name, dict(stats, phases_s=dict(stats["phases_s"])))
+                                for (name, stats) in cls._operations.items())
+
+        # Samples of a metric family must be grouped under its TYPE line
+        lines = ["# HELP fstoken_operations_total Operations answered by the daemon",
+                 "# TYPE fstoken_operations_total counter"]
+        for (name, stats) in operations:
+            lines.append(f'fstoken_operations_total{{operation="{name}"}} {stats["count"]}')
+
+        lines += ["# HELP fstoken_operation_errors_total Operations answered with an error",
+                  "# TYPE fstoken_operation_errors_total counter"]
+        for (name, stats) in operations:
+            lines.append(f'fstoken_operation_errors_total{{operation="{name}"}} {stats["errors"]}')
+
+        lines += ["# HELP fstoken_operation_duration_seconds Operation latency",
+                  "# TYPE fstoken_operation_duration_seconds histogram"]
+        for (name, stats) in operations:
+            label = f'operation="{name}"'
+            cumulative = 0
+            for (bound, count) in zip(cls.LATENCY_BUCKETS_S, stats["latency_buckets"]):
+                cumulative += count
+                lines.append("fstoken_operation_duration_seconds_bucket"
+                             f'{{{label},le="{bound}"}} {cumulative}')
+            lines.append("fstoken_operation_duration_seconds_bucket"
+                         f'{{{label},le="+Inf"}} {stats["count"]}')
+            lines.append("fstoken_operation_duration_seconds_sum"
+                         f'{{{label}}} {stats["latency_sum_s"]}')
+            lines.append("fstoken_operation_duration_seconds_count"
+                         f'{{{label}}} {stats["count"]}')
+
+        lines += ["# HELP fstoken_operation_phase_seconds_total Time spent per phase",
+                  "# TYPE fstoken_operation_phase_seconds_total counter"]
+        for (name, stats) in operations:
+            for (phase, spent) in stats["phases_s"].items():
+                lines.append("fstoken_operation_phase_seconds_total"
+                             f'{{operation="{name}",phase="{phase}"}} {spent}')
+
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def write_prometheus(cls, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as metrics_file:
+            metrics_file.write(cls._format_prometheus())
+        replace(tmp_path, path)
+
+    @classmethod
+    def start_exporter(cls, stop: Event) -> Thread | None:
+        if not cls.ENABLED or not cls.PROMETHEUS_FILE:
+            return None
+
+        def export() -> None:
+            while not stop.wait(cls.EXPORT_INTERVAL_S):
+                cls.write_prometheus(cls.PROMETHEUS_FILE)
+            cls.write_prometheus(cls.PROMETHEUS_FILE)
+
+        exporter = Thread(target=export, daemon=True)
+        exporter.start()
+        return exporter
+
+
+def timed_phase(name: str) -> Callable[[Callable], Callable]:
+    def decorator(fn: Callable) -> Callable:
+        if not Metrics.ENABLED:
+            return fn
+
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            with _PhaseContext(name):
+                return fn(*args, **kwargs)
+
+        return timed
+
+    return decorator
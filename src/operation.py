@@ -1,15 +1,26 @@
 from argparse import Namespace
 from pathlib import Path
-from os import remove
+from os import remove, stat
+from functools import partial
 from subprocess import run
 
-from token import Token, Grants
 from file import File
 from helpers import Message, remove_whitespace_newline
-from keystore import Keystore
+
+# Same as typing.TYPE_CHECKING, without importing typing on every cli call
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from captoken import Grants
+
+# Operations are built by the cli and run by the daemon. Modules only the
+# daemon uses are imported inside the methods running there, so the cli
+# startup never loads the keystore, tokens, codecs, caches or the watcher.
 
 
 class BaseOp:
+    # Interactive operations get a second message round with the client
+    INTERACTIVE = False
+
     def __init__(self, args: Namespace):
         self._args = args
         self._requester_has_access_to_file = False
@@ -39,24 +50,37 @@ class Delete(BaseOp):
         return ""
 
     def run_priviledged(self) -> Message:
-        (was_encrypted, prevkey) = Keystore.search_entry_state(self._args.file)
-        if not prevkey:
-            return Message(
-                payload=None,
-                err=f"File not found in {Keystore.STORE_FILENAME}"
-            )
+        from cache import ContentCache
+        from keystore import Keystore
+        from lock import PathLocks
 
-        Keystore.change_entry(self._args.file, delete=True)
+        with PathLocks.writing(self._args.file):
+            (was_encrypted, prevkey, prevoptions) = \
+                Keystore.search_entry(self._args.file)
+            if not prevkey:
+                return Message(
+                    payload=None,
+                    err=f"File not found in {Keystore.STORE_FILENAME}"
+                )
 
-        if was_encrypted:
-            File.decrypt(self._args.file, prevkey)
+            Keystore.change_entry(self._args.file, delete=True)
+            ContentCache.invalidate(self._args.file)
 
-        return Message(payload="", err="")
+            if was_encrypted:
+                File.decrypt(self._args.file,
+                             prevkey,
+                             prevoptions.get("compress", ""))
+
+            return Message(payload="", err="")
 
 
 class Invoke(BaseOp):
+    INTERACTIVE = True
+
     @staticmethod
     def prompt_user_with_file_editor(file_info: Message) -> Message:
+        from captoken import Grants
+
         (filename, file_content, allowed_mode) = file_info.payload
 
         default_payload = (None, None)
@@ -86,77 +110,135 @@ class Invoke(BaseOp):
         return Message(payload=(filename if new_content else None, new_content), err="")
 
     @staticmethod
-    def _get_file_content(filename: str) -> tuple[bool, str, str]:
-        (is_encrypted, filekey) = Keystore.search_entry_state(filename)
+    def _get_file_content(filename: str) -> tuple[bool, str, str, str]:
+        from cache import ContentCache
+        from keystore import Keystore
+        from metrics import Metrics
+
+        (is_encrypted, filekey, options) = Keystore.search_entry(filename)
+        compression = options.get("compress", "")
 
         content = ""
-        if is_encrypted:
-            content = File.decrypt_to_read(filename, filekey)
+        if is_encrypted and options.get("cache") == "1":
+            content = ContentCache.get_or_load(
+                filename,
+                filekey,
+                partial(File.decrypt_to_read, filename, filekey, compression)
+            )
+        elif is_encrypted:
+            content = File.decrypt_to_read(filename, filekey, compression)
         else:
-            with open(filename, "r") as f:
+            with Metrics.phase("file_io"), open(filename, "r") as f:
                 content = f.read()
 
-        return is_encrypted, filekey, content
+        return is_encrypted, filekey, compression, content
 
     @classmethod
     def update_file(cls, file_info: Message) -> None:
+        from cache import ContentCache
+        from lock import PathLocks
+        from metrics import Metrics
+
         (filename, new_content) = file_info.payload
         if not filename or not new_content:
             return
 
-        (is_encrypted, filekey, old_content) = cls._get_file_content(filename)
+        with PathLocks.writing(filename):
+            (is_encrypted, filekey, compression, old_content) = \
+                cls._get_file_content(filename)
 
-        if new_content == old_content:
-            return
+            if new_content == old_content:
+                return
 
-        with open(filename, "w") as file:
-            file.write(new_content)
+            ContentCache.invalidate(filename)
+            with Metrics.phase("file_io"), open(filename, "w") as file:
+                file.write(new_content)
 
-        if is_encrypted and filekey:
-            File.encrypt(filename, filekey)
+            if is_encrypted and filekey:
+                File.encrypt(filename, filekey, compression)
 
 
     def __init__(self, args: Namespace):
         super().__init__(args)
 
+    def _validate_token(self, scopes: list) -> "Grants":
+        # A file own entry is the only key accepted for it, so rotating it
+        # revokes every token. Files without one take the key derived from
+        # the nearest enrolled directory, then each directory-wide key
+        from captoken import Token
+        from keystore import Keystore
+
+        (scope, _, key, _) = scopes[0]
+        if scope == self._args.file:
+            return Token.validate_cached(self._args.token, key, "")
+
+        candidates = [(Keystore.derive_filekey(scope, key, self._args.file), "")]
+        candidates.extend((key, scope) for (scope, _, key, options) in scopes
+                          if options.get("scope") == "dir")
+
+        validation_err = None
+        for (key, scope) in candidates:
+            try:
+                return Token.validate_cached(self._args.token, key, scope)
+            except (AssertionError, KeyError) as err:
+                validation_err = err
+
+        raise validation_err
+
     def run_priviledged(self) -> Message:
-        default_payload = (None, None, None)
+        from keystore import Keystore
+        from lock import PathLocks
 
-        (is_encrypted, filekey) = Keystore.search_entry_state(self._args.file)
-        if not filekey:
-            return Message(
-                payload=default_payload,
-                err=f"File not found in {Keystore.STORE_FILENAME}"
-            )
+        default_payload = (None, None, None)
 
-        try:
-            initial_grant = None
-            extracted_grant = Token.validate(self._args.token,
-                                             initial_grant,
-                                             filekey)
-        except (AssertionError, KeyError) as err:
-            return Message(payload=default_payload, err=err)
+        if Path(self._args.file).is_dir():
+            return Message(payload=default_payload,
+                           err=f"Cannot invoke directory {self._args.file}")
+
+        with PathLocks.reading(self._args.file):
+            scopes = Keystore.search_scopes(self._args.file)
+            if not scopes:
+                return Message(
+                    payload=default_payload,
+                    err=f"File not found in {Keystore.STORE_FILENAME}"
+                )
+
+            try:
+                extracted_grant = self._validate_token(scopes)
+            except (AssertionError, KeyError) as err:
+                return Message(payload=default_payload, err=err)
+
+            try:
+                (_, _, _, file_content) = self._get_file_content(self._args.file)
+            except FileNotFoundError:
+                return Message(payload=default_payload, err=f"File {self._args.file} not found")
+            except PermissionError:
+                return Message(
+                    payload=default_payload,
+                    err=f"Could not open {self._args.file}, fstoken user not authorized"
+                )
 
-        try:
-            (_, _, file_content) = self._get_file_content(self._args.file)
-        except FileNotFoundError:
-            return Message(payload=default_payload, err=f"File {self._args.file} not found")
-        except PermissionError:
             return Message(
-                payload=default_payload,
-                err=f"Could not open {self._args.file}, fstoken user not authorized"
+                payload=(self._args.file, file_content, extracted_grant.value),
+                err=""
             )
 
-        return Message(
-            payload=(self._args.file, file_content, extracted_grant.value),
-            err=""
-        )
-
 
 class Add(BaseOp):
     def __init__(self, args: Namespace):
         super().__init__(args)
 
+    def _get_entry_options(self) -> dict[str, str]:
+        options = {}
+        if self._args.cache:
+            options["cache"] = "1"
+        if self._args.compress:
+            options["compress"] = self._args.compress
+        if Path(self._args.file).is_dir():
+            options["scope"] = "dir"
+
+        return options
+
     def run_unpriviledged(self) -> str:
         grant_err = File.grant_fstoken_access(self._args.file)
         if grant_err:
@@ -167,49 +249,216 @@ class Add(BaseOp):
         return ""
 
     def run_priviledged(self) -> Message:
+        from cache import ContentCache
+        from codec import Codec
+        from keystore import Keystore
+        from lock import PathLocks
+
         base_op_result = super().run_priviledged()
         if base_op_result.err:
             return base_op_result
 
-        (was_encrypted, prevkey) = Keystore.search_entry_state(self._args.file)
+        if self._args.encrypt and Path(self._args.file).is_dir():
+            return Message(
+                payload=None,
+                err="Directories cannot be encrypted, add its files instead"
+            )
+
+        if self._args.compress and not self._args.encrypt:
+            return Message(payload=None,
+                           err="Compression is only applied to encrypted files")
+
+        if self._args.compress \
+                and self._args.compress not in Codec.get_available_algorithms():
+            return Message(
+                payload=None,
+                err=f"Invalid compression, must be: {Codec.get_available_algorithms()}"
+            )
+
+        with PathLocks.writing(self._args.file):
+            (was_encrypted, prevkey, prevoptions) = \
+                Keystore.search_entry(self._args.file)
 
-        newkey = Keystore.change_entry(self._args.file,
-                                       encrypt=self._args.encrypt,
-                                       rotate_key=self._args.rotate,
-                                       delete=False)
+            # The inode lets the keystore watcher follow the file on moves
+            options = self._get_entry_options()
+            options[Keystore.INODE_OPTION] = str(stat(self._args.file).st_ino)
 
-        if was_encrypted:
-            File.decrypt(self._args.file, prevkey)
-        if self._args.encrypt:
-            File.encrypt(self._args.file, newkey)
+            newkey = Keystore.change_entry(self._args.file,
+                                           encrypt=self._args.encrypt,
+                                           rotate_key=self._args.rotate,
+                                           delete=False,
+                                           options=options)
+            ContentCache.invalidate(self._args.file)
 
-        return Message(payload=newkey, err="")
+            if was_encrypted:
+                File.decrypt(self._args.file,
+                             prevkey,
+                             prevoptions.get("compress", ""))
+            if self._args.encrypt:
+                File.encrypt(self._args.file, newkey, self._args.compress)
+
+            return Message(payload=newkey, err="")
 
 
 class Delegate(Add):
     def __init__(self, args: Namespace):
         super().__init__(args)
 
+    def _get_requested_grants(self) -> list[str]:
+        if isinstance(self._args.grant, str):
+            return [self._args.grant]
+
+        return list(self._args.grant)
+
+    def _keep_stored_entry_state(self, is_encrypted: bool, options: dict[str, str]) -> None:
+        # Flags left out keep what is stored, delegating never downgrades an entry
+        self._args.encrypt = self._args.encrypt or is_encrypted
+        self._args.cache = self._args.cache or options.get("cache") == "1"
+        self._args.compress = self._args.compress or options.get("compress", "")
+
+    def _get_unchanged_filekey(self) -> str:
+        # Delegating an enrolled file is a keystore lookup, the Add rewrite
+        # only runs for rotations and flags explicitly changing the entry
+        from keystore import Keystore
+
+        scopes = Keystore.search_scopes(self._args.file)
+        if not scopes:
+            return ""
+
+        (scope, is_encrypted, key, options) = scopes[0]
+        if scope != self._args.file:
+            # Files beneath an enrolled directory take a derived key
+            # and need no entry of their own
+            options = {}
+            key = Keystore.derive_filekey(scope, key, self._args.file)
+        else:
+            self._keep_stored_entry_state(is_encrypted, options)
+
+        if self._args.rotate \
+                or self._args.encrypt != is_encrypted \
+                or self._get_entry_options() != Keystore.get_requested_options(options):
+            return ""
+
+        return key
+
+    def run_unpriviledged(self) -> str:
+        if not File.has_fstoken_access(self._args.file):
+            return super().run_unpriviledged()
+
+        access_err = File.check_requester_access(self._args.file)
+        if access_err:
+            return access_err
+
+        self._requester_has_access_to_file = True
+
+        return ""
+
     def run_priviledged(self) -> Message:
-        add_op_result = super().run_priviledged()
-        if add_op_result.err:
-            return add_op_result
+        from captoken import Token
+        from lock import PathLocks
 
+        base_op_result = BaseOp.run_priviledged(self)
+        if base_op_result.err:
+            return base_op_result
+
+        with PathLocks.reading(self._args.file):
+            filekey = self._get_unchanged_filekey()
+        if not filekey:
+            add_op_result = super().run_priviledged()
+            if add_op_result.err:
+                return add_op_result
+
+            filekey = add_op_result.payload
+
+        scope = self._args.file if Path(self._args.file).is_dir() else ""
+
+        tokens = []
         try:
             seed = remove_whitespace_newline(self._args.key)
-            token = Token.encode(seed,
-                                 raw_payload={"filekey": add_op_result.payload,
-                                              "grant": self._args.grant,
-                                              "proof": [self._args.token]})
+            for grant in self._get_requested_grants():
+                tokens.append(Token.encode(seed,
+                                           raw_payload={"filekey": filekey,
+                                                        "grant": grant,
+                                                        "proof": [self._args.token],
+                                                        "scope": scope}))
         except (AssertionError, KeyError) as err:
             return Message(payload=None, err=err)
 
-        return Message(payload=token, err="", hide_payload=False)
+        return Message(payload="\n".join(tokens), err="", hide_payload=False)
+
+
+class Read(Invoke):
+    """
+    Non-interactive Invoke, answers with the file content instead of
+    opening an editor. Used by batch mode for invoke-read items.
+    """
+    INTERACTIVE = False
+
+    def __init__(self, args: Namespace):
+        super().__init__(args)
+
+    def run_priviledged(self) -> Message:
+        invoke_result = super().run_priviledged()
+        if invoke_result.err:
+            return Message(payload=None, err=invoke_result.err)
+
+        (_, file_content, _) = invoke_result.payload
+        return Message(payload=file_content, err="", hide_payload=False)
+
+
+class Batch(BaseOp):
+    """
+    Carries many operations over a single daemon connection. They run
+    in order and every one of them answers with its own message, so a
+    failing item does not abort the remaining ones.
+    """
+    def __init__(self, args: Namespace, operations: list[BaseOp]):
+        super().__init__(args)
+        self._operations = operations
+
+    def run_priviledged(self) -> Message:
+        from metrics import Metrics
+
+        results = []
+        for operation in self._operations:
+            with Metrics.operation(type(operation).__name__) as op_metrics:
+                try:
+                    op_result = operation.run_priviledged()
+                except Exception as err:
+                    op_result = Message(payload=None,
+                                        err=f"Unexpected runtime error: {repr(err)}")
+                op_metrics.failed = bool(op_result.err)
+            results.append(op_result)
+
+        return Message(payload=results, err="", hide_payload=False)
+
+
+class Stats(BaseOp):
+    def __init__(self, args: Namespace):
+        super().__init__(args)
+
+    def run_priviledged(self) -> Message:
+        from json import dumps
+
+        from cache import ContentCache
+        from lock import PathLocks
+        from metrics import Metrics
+        from watcher import KeystoreWatcher
+
+        stats = {"content_cache": ContentCache.get_stats(),
+                 "path_locks": PathLocks.get_stats(),
+                 "metrics": Metrics.get_stats(),
+                 "keystore_watcher": KeystoreWatcher.get_stats()}
+
+        return Message(payload=dumps(stats), err="", hide_payload=False)
 
 
 class OperationRegistry:
     @staticmethod
     def get_operation_by_args(args: Namespace) -> BaseOp:
+        if args.stats:
+            return Stats(args)
+
         if args.delete:
             return Delete(args)
 
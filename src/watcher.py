@@ -0,0 +1,420 @@
+from ctypes import CDLL, get_errno
+from errno import EACCES, ENOSPC, EPERM
+from os import close, fsdecode, fsencode, lstat, read, stat, strerror
+from os.path import join
+from pathlib import Path
+from select import select
+from struct import calcsize, unpack_from
+from threading import Event, Lock, Thread
+from time import monotonic, time
+
+from crypto import NaclBinder
+from keystore import Keystore
+from lock import PathLocks
+from helpers import log_err
+
+
+class _Inotify:
+    """
+    Minimal inotify(7) binding over the process libc. Only directories
+    are watched; events about their children carry the child name.
+    """
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+        | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    READ_SIZE = 64 * 1024
+
+    _EVENT_HEADER = "iIII"
+    _EVENT_HEADER_SIZE = calcsize(_EVENT_HEADER)
+
+    def __init__(self):
+        self._libc = CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = get_errno()
+            raise OSError(errno, strerror(errno))
+
+    def add_watch(self, directory: str) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, fsencode(directory),
+                                          self.WATCH_MASK)
+        if wd < 0:
+            errno = get_errno()
+            raise OSError(errno, strerror(errno), directory)
+
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        # Fails for watches the kernel already dropped, which is fine
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> list[tuple[int, int, int, str]]:
+        try:
+            data = read(self.fd, self.READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, name_len) = unpack_from(self._EVENT_HEADER, data, offset)
+            offset += self._EVENT_HEADER_SIZE
+            # Names are padded with NUL bytes up to name_len
+            name = fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+            events.append((wd, mask, cookie, name))
+            offset += name_len
+
+        return events
+
+    def close(self) -> None:
+        close(self.fd)
+
+
+class KeystoreWatcher:
+    """
+    Keeps keystore entries in line with files renamed, moved or deleted
+    outside fstoken. Directories holding enrolled paths are watched with
+    inotify and rescanned shortly after they change. A periodic pass
+    rescans the directories whose mtime moved, which covers lost events
+    and directories the daemon is not allowed to watch, then compacts
+    the keystore. Entries only follow moves inotify reports as a rename
+    pair, and only when the file there is still the enrolled one; every
+    other entry whose file is gone or replaced is tombstoned.
+    """
+    SCAN_INTERVAL_S = 60.0
+    DEBOUNCE_S = 0.2
+    STOP_POLL_S = 1.0
+    RETRY_S = 5.0
+    ENCRYPTED_TOMBSTONE_TTL_S = 7 * 24 * 3600.0
+
+    _watches: dict[str, int] = {}
+    _watched_dirs: dict[int, str] = {}
+    _unwatchable: set[str] = set()
+    _dir_mtimes: dict[str, int | None] = {}
+    _keystore_mtime = 0
+    _stats_lock = Lock()
+    _stats = {"scans": 0, "dirs_rescanned": 0, "moved": 0, "tombstoned": 0,
+              "restored": 0, "compacted": 0, "failed_scans": 0, "watched_dirs": 0,
+              "unwatchable_dirs": 0, "inotify": False, "running": False}
+
+    @classmethod
+    def _count(cls, **increments: int) -> None:
+        with cls._stats_lock:
+            for (name, increment) in increments.items():
+                cls._stats[name] += increment
+
+    @classmethod
+    def _count_replacements(cls, dirs_count: int, replacements: list[tuple]) -> None:
+        tombstone = Keystore.TOMBSTONE_OPTION
+        with cls._stats_lock:
+            cls._stats["scans"] += 1
+            cls._stats["dirs_rescanned"] += dirs_count
+            for (seen, new) in replacements:
+                cls._stats["moved"] += seen[0] != new[0]
+                cls._stats["tombstoned"] += tombstone in new[3] and tombstone not in seen[3]
+                cls._stats["restored"] += tombstone in seen[3] and tombstone not in new[3]
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        with cls._stats_lock:
+            return dict(cls._stats)
+
+    @staticmethod
+    def _get_mtime(directory: str) -> int | None:
+        try:
+            return stat(directory).st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def _group_by_dir(entries: list[tuple]) -> dict[str, list[tuple]]:
+        by_dir = {}
+        for entry in entries:
+            by_dir.setdefault(str(Path(entry[0]).parent), []).append(entry)
+
+        return by_dir
+
+    @staticmethod
+    def _get_moved_path(filestring: str, old: str, new: str) -> str | None:
+        if filestring == old:
+            return new
+        if filestring.startswith(f"{old}/"):
+            return new + filestring[len(old):]
+
+        return None
+
+    @staticmethod
+    def _with_options(entry: tuple, filestring: str, **options: str | None) -> tuple:
+        (_, encrypted, keystring, entry_options) = entry
+        new_options = dict(entry_options)
+        for (name, value) in options.items():
+            if value is None:
+                new_options.pop(name, None)
+            else:
+                new_options[name] = value
+
+        return (filestring, encrypted, keystring, new_options)
+
+    @staticmethod
+    def _authenticates(filestring: str, keystring: str) -> bool:
+        try:
+            with PathLocks.reading(filestring), open(filestring, "rb") as file:
+                NaclBinder.secretbox_decrypt(keystring, file.read())
+        except Exception:
+            return False
+
+        return True
+
+    @classmethod
+    def _is_enrolled_file(cls, entry: tuple, filestring: str) -> bool:
+        # Freed inode numbers are handed to the next file created, the
+        # content of an encrypted file must also still authenticate
+        (_, encrypted, keystring, options) = entry
+        try:
+            current_ino = str(lstat(filestring).st_ino)
+        except OSError:
+            return False
+
+        if current_ino != options.get(Keystore.INODE_OPTION):
+            return False
+
+        return not encrypted or cls._authenticates(filestring, keystring)
+
+    @classmethod
+    def _reconcile_entry(cls, entry: tuple, now: float) -> tuple:
+        (filestring, encrypted, keystring, options) = entry
+        recorded_ino = options.get(Keystore.INODE_OPTION, "")
+        tombstoned = Keystore.TOMBSTONE_OPTION in options
+        try:
+            current_ino = str(lstat(filestring).st_ino)
+        except FileNotFoundError:
+            current_ino = ""
+        except OSError:
+            # Not reachable by the daemon, nothing can be told about it
+            return entry
+
+        if current_ino == recorded_ino and current_ino and not tombstoned:
+            return entry
+
+        # Entries enrolled before inodes were recorded take the current
+        # one, tombstones are lifted once the enrolled file is back
+        if current_ino and (not recorded_ino or current_ino == recorded_ino) \
+                and (not encrypted or cls._authenticates(filestring, keystring)):
+            return cls._with_options(entry, filestring,
+                                     **{Keystore.INODE_OPTION: current_ino,
+                                        Keystore.TOMBSTONE_OPTION: None})
+
+        if tombstoned:
+            return entry
+
+        return cls._with_options(entry, filestring,
+                                 **{Keystore.TOMBSTONE_OPTION: str(int(now))})
+
+    @classmethod
+    def _get_moves(cls,
+                   entries: list[tuple],
+                   moves: list[tuple[str, str]]) -> dict[str, tuple[tuple, tuple]]:
+        # Paths follow each rename in order, entries beneath a moved
+        # directory included, and are checked on their final location
+        targets = {}
+        for (old, new) in moves:
+            for entry in entries:
+                moved_to = cls._get_moved_path(targets.get(entry[0], entry[0]), old, new)
+                if moved_to is not None:
+                    targets[entry[0]] = moved_to
+
+        live = {entry[0] for entry in entries
+                if Keystore.TOMBSTONE_OPTION not in entry[3]}
+        moved = {}
+        for entry in entries:
+            moved_to = targets.get(entry[0])
+            if moved_to is None or moved_to in live \
+                    or not cls._is_enrolled_file(entry, moved_to):
+                continue
+
+            moved[entry[0]] = (entry, cls._with_options(
+                entry, moved_to, **{Keystore.TOMBSTONE_OPTION: None}))
+            live.add(moved_to)
+
+        return moved
+
+    @classmethod
+    def _reconcile(cls,
+                   directories: set[str] | None,
+                   moves: list[tuple[str, str]]) -> set[str]:
+        entries = Keystore.list_entries()
+        by_dir = cls._group_by_dir(entries)
+        if directories is None:
+            directories = {directory for directory in by_dir
+                           if cls._get_mtime(directory) != cls._dir_mtimes.get(directory)}
+        directories &= set(by_dir)
+
+        for directory in directories:
+            # Recorded first, changes made while rescanning show up next pass
+            cls._dir_mtimes[directory] = cls._get_mtime(directory)
+
+        replacements = cls._get_moves(entries, moves)
+
+        now = time()
+        for directory in directories:
+            for entry in by_dir[directory]:
+                if entry[0] in replacements:
+                    continue
+
+                new_entry = cls._reconcile_entry(entry, now)
+                if new_entry != entry:
+                    replacements[entry[0]] = (entry, new_entry)
+
+        if replacements:
+            Keystore.replace_entries(replacements)
+            # Moved entries are watched from their new directory
+            for (_, new_entry) in replacements.values():
+                by_dir.setdefault(str(Path(new_entry[0]).parent), [])
+
+        if directories or moves:
+            cls._count_replacements(len(directories), list(replacements.values()))
+
+        for directory in set(cls._dir_mtimes) - set(by_dir):
+            del cls._dir_mtimes[directory]
+
+        return set(by_dir)
+
+    @classmethod
+    def _sync_watches(cls, inotify: _Inotify | None, directories: set[str]) -> None:
+        if inotify is None:
+            return
+
+        for directory in set(cls._watches) - directories:
+            wd = cls._watches.pop(directory)
+            cls._watched_dirs.pop(wd, None)
+            inotify.rm_watch(wd)
+
+        for directory in directories - set(cls._watches) - cls._unwatchable:
+            try:
+                wd = inotify.add_watch(directory)
+            except OSError as err:
+                # Left to the periodic scan, other errors are retried
+                if err.errno in (EACCES, EPERM, ENOSPC):
+                    cls._unwatchable.add(directory)
+                continue
+
+            cls._watches[directory] = wd
+            cls._watched_dirs[wd] = directory
+
+        with cls._stats_lock:
+            cls._stats["watched_dirs"] = len(cls._watches)
+            cls._stats["unwatchable_dirs"] = len(cls._unwatchable)
+
+    @classmethod
+    def _get_changes(cls, inotify: _Inotify) -> tuple[set[str] | None, list[tuple[str, str]]]:
+        changed = set()
+        moves = []
+        moved_from = {}
+        events = inotify.read_events()
+        while events:
+            for (wd, mask, cookie, name) in events:
+                if mask & _Inotify.IN_Q_OVERFLOW:
+                    return None, []
+
+                directory = cls._watched_dirs.get(wd)
+                if directory is None:
+                    continue
+
+                changed.add(directory)
+                # Renames are reported as a pair sharing a cookie, a lone
+                # half is a move in or out of the watched directories
+                if mask & _Inotify.IN_MOVED_FROM:
+                    moved_from[cookie] = join(directory, name)
+                elif mask & _Inotify.IN_MOVED_TO and cookie in moved_from:
+                    moves.append((moved_from.pop(cookie), join(directory, name)))
+
+                # The watch follows the moved inode, not the watched path
+                if mask & (_Inotify.IN_MOVE_SELF | _Inotify.IN_IGNORED):
+                    if not mask & _Inotify.IN_IGNORED:
+                        inotify.rm_watch(wd)
+                    cls._watched_dirs.pop(wd, None)
+                    cls._watches.pop(directory, None)
+
+            events = inotify.read_events()
+
+        return changed, moves
+
+    @classmethod
+    def _scan(cls,
+              inotify: _Inotify | None,
+              directories: set[str] | None,
+              moves: list[tuple[str, str]]) -> None:
+        periodic = directories is None
+        cls._keystore_mtime = Keystore.get_mtime()
+        if periodic:
+            cls._unwatchable.clear()
+
+        cls._sync_watches(inotify, cls._reconcile(directories, moves))
+
+        if periodic:
+            compacted = Keystore.compact(cls.ENCRYPTED_TOMBSTONE_TTL_S, time())
+            cls._count(compacted=compacted)
+
+    @classmethod
+    def _watch(cls, stop: Event) -> None:
+        try:
+            inotify = _Inotify()
+        except (OSError, AttributeError) as err:
+            log_err(f"Keystore watcher falling back to periodic scans: {err}")
+            inotify = None
+
+        with cls._stats_lock:
+            cls._stats["inotify"] = inotify is not None
+            cls._stats["running"] = True
+
+        next_scan = 0.0
+        try:
+            while not stop.is_set():
+                now = monotonic()
+                try:
+                    if now >= next_scan:
+                        cls._scan(inotify, None, [])
+                        next_scan = now + cls.SCAN_INTERVAL_S
+                        continue
+
+                    timeout = min(next_scan - now, cls.STOP_POLL_S)
+                    if inotify is None:
+                        stop.wait(timeout)
+                        continue
+
+                    (ready, _, _) = select([inotify.fd], [], [], timeout)
+                    if ready:
+                        # Coalesces bursts of events, e.g. a whole tree moved
+                        stop.wait(cls.DEBOUNCE_S)
+                        cls._scan(inotify, *cls._get_changes(inotify))
+                    elif Keystore.get_mtime() != cls._keystore_mtime:
+                        # Directories of newly enrolled paths get their watch
+                        cls._scan(inotify, set(), [])
+                except Exception as err:
+                    # E.g. the keystore is not created yet, the watcher keeps
+                    # running and retries with a full scan
+                    log_err(f"Keystore watcher scan failed: {err}")
+                    cls._count(failed_scans=1)
+                    next_scan = monotonic() + cls.RETRY_S
+                    stop.wait(cls.RETRY_S)
+        finally:
+            with cls._stats_lock:
+                cls._stats["running"] = False
+            if inotify is not None:
+                inotify.close()
+
+    @classmethod
+    def start(cls, stop: Event) -> Thread:
+        watcher = Thread(target=cls._watch, args=(stop,), daemon=True)
+        watcher.start()
+        return watcher